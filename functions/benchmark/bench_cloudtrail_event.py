@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+"""
+Ingestion benchmark for the CloudTrail event function.
+
+Generates synthetic gzipped CloudTrail files and runs them through the
+function's handler, with S3, DynamoDB and SNS replaced by local in-memory
+stand-ins. Reports throughput and the number of AWS API calls made per
+record. With --trace-memory, also reports the peak Python memory allocated
+during the handler call alone, measured with tracemalloc, which slows the
+run down several times.
+"""
+
+import argparse
+import collections
+import gzip
+import io
+import json
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+import uuid
+
+os.environ.setdefault('APP_NAME', "spacesiren-bench")
+os.environ.setdefault('AWS_DEFAULT_REGION', "us-east-1")
+os.environ.setdefault('HONEY_EVENT_SNS_TOPIC_ARN', "arn:aws:sns:us-east-1:111122223333:bench")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import app_common  # noqa: E402
+import task_cloudtrail_event  # noqa: E402
+
+ACCOUNT_ID = "111122223333"
+REGIONS = ["us-east-1", "us-east-2", "us-west-2", "eu-west-1", "ap-southeast-2"]
+EVENTS = [
+    ("s3.amazonaws.com", "GetObject"),
+    ("s3.amazonaws.com", "ListBuckets"),
+    ("ec2.amazonaws.com", "DescribeInstances"),
+    ("iam.amazonaws.com", "GetUser"),
+    ("sts.amazonaws.com", "GetCallerIdentity"),
+    ("lambda.amazonaws.com", "ListFunctions"),
+]
+USER_AGENTS = [
+    "aws-cli/2.4.6 Python/3.8.8 Linux/5.10.0 exe/x86_64.ubuntu.20",
+    "Boto3/1.20.24 Python/3.9.7 Linux/5.4.0 Botocore/1.23.24",
+    "console.amazonaws.com",
+]
+
+calls = collections.Counter()
+
+
+#================================================
+# Synthetic CloudTrail
+#================================================
+def random_access_key_id(rng):
+    return "AKIA" + "".join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(16))
+
+
+def generate_record(rng, access_key_id, padding):
+    event_source, event_name = rng.choice(EVENTS)
+    record = {
+        'eventVersion': "1.08",
+        'eventTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(1609459200 + rng.randrange(86400))),
+        'eventSource': event_source,
+        'eventName': event_name,
+        'awsRegion': rng.choice(REGIONS),
+        'sourceIPAddress': "203.0.113.{}".format(rng.randrange(256)),
+        'userAgent': rng.choice(USER_AGENTS),
+        'requestParameters': {'bucketName': "bench-bucket", 'key': "x" * padding},
+        'responseElements': None,
+        'requestID': str(uuid.UUID(int=rng.getrandbits(128))),
+        'eventID': str(uuid.UUID(int=rng.getrandbits(128))),
+        'readOnly': True,
+        'eventType': "AwsApiCall",
+        'managementEvent': True,
+        'recipientAccountId': ACCOUNT_ID,
+        'tlsDetails': {
+            'tlsVersion': "TLSv1.2",
+            'cipherSuite': "ECDHE-RSA-AES128-GCM-SHA256",
+            'clientProvidedHostHeader': "{}.amazonaws.com".format(event_source.split('.')[0])
+        }
+    }
+
+    if access_key_id:
+        record['userIdentity'] = {
+            'type': "IAMUser",
+            'principalId': "AIDA" + access_key_id[4:],
+            'arn': "arn:aws:iam::{}:user/bench".format(ACCOUNT_ID),
+            'accountId': ACCOUNT_ID,
+            'accessKeyId': access_key_id,
+            'userName': "bench"
+        }
+    else:
+        record['userIdentity'] = {'type': "AWSService", 'invokedBy': event_source}
+
+    return record
+
+
+def generate_cloudtrail_file(rng, num_records, access_key_ids, honey_key_ids, hit_ratio, record_bytes):
+    """
+    Build one gzipped CloudTrail file. A tenth of the non-honey records are
+    service events without an access key.
+    """
+    padding = max(0, record_bytes - 1100)
+    records = []
+
+    for _ in range(num_records):
+        if honey_key_ids and rng.random() < hit_ratio:
+            access_key_id = rng.choice(honey_key_ids)
+        elif rng.random() < 0.1:
+            access_key_id = None
+        else:
+            access_key_id = rng.choice(access_key_ids)
+
+        records.append(generate_record(rng, access_key_id, padding))
+
+    return gzip.compress(json.dumps({'Records': records}).encode('utf-8'))
+
+
+#================================================
+# Local AWS stand-ins
+#================================================
+class LocalClientError(Exception):
+    pass
+
+
+class LocalBody(io.BytesIO):
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class LocalS3:
+    class exceptions:
+        ClientError = LocalClientError
+        NoSuchKey = LocalClientError
+
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        calls['s3.get_object'] += 1
+        if (Bucket, Key) not in self.objects:
+            raise LocalClientError("NoSuchKey")
+        return {'Body': LocalBody(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body):
+        calls['s3.put_object'] += 1
+        self.objects[(Bucket, Key)] = Body
+
+
+class LocalSNS:
+    class exceptions:
+        ThrottledException = LocalClientError
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, TopicArn, Message):
+        calls['sns.publish'] += 1
+        self.messages.append(Message)
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        calls['sns.publish_batch'] += 1
+        self.messages.extend(entry['Message'] for entry in PublishBatchRequestEntries)
+        return {'Successful': [{'Id': entry['Id']} for entry in PublishBatchRequestEntries], 'Failed': []}
+
+
+class LocalTable:
+    def __init__(self, name, hash_key):
+        self.name = name
+        self.hash_key = hash_key
+        self.items = {}
+
+    def get_item(self, Key, **_kwargs):
+        calls['dynamodb.get_item'] += 1
+        item = self.items.get(Key[self.hash_key])
+        return {'Item': dict(item)} if item is not None else {}
+
+    def put_item(self, Item):
+        calls['dynamodb.put_item'] += 1
+        self.items[Item[self.hash_key]] = dict(Item)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, **_kwargs):
+        calls['dynamodb.update_item'] += 1
+        item = self.items.setdefault(Key[self.hash_key], dict(Key))
+        item['Version'] = item.get('Version', 0) + ExpressionAttributeValues[':one']
+
+    def scan(self, ScanFilter=None, AttributesToGet=None, **_kwargs):
+        calls['dynamodb.scan'] += 1
+        items = list(self.items.values())
+
+        for attribute, condition in (ScanFilter or {}).items():
+            items = [item for item in items if item.get(attribute) == condition['AttributeValueList'][0]]
+        if AttributesToGet:
+            items = [{attribute: item[attribute] for attribute in AttributesToGet} for item in items]
+
+        return {'Items': items}
+
+
+class LocalDynamoDB:
+    def __init__(self, tables):
+        self.tables = {table.name: table for table in tables}
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems):
+        calls['dynamodb.batch_get_item'] += 1
+        responses = {}
+
+        for name, request in RequestItems.items():
+            table = self.tables[name]
+            responses[name] = [
+                dict(table.items[key[table.hash_key]])
+                for key in request['Keys']
+                if key[table.hash_key] in table.items
+            ]
+
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+def install_stand_ins(honey_key_ids):
+    app_name = os.environ['APP_NAME']
+    tables = {
+        'honey_tokens': LocalTable("{}-honey-tokens".format(app_name), 'AccessKeyID'),
+        'iam_users': LocalTable("{}-iam-users".format(app_name), 'Username'),
+        'state': LocalTable("{}-state".format(app_name), 'StateID'),
+    }
+
+    for access_key_id in honey_key_ids:
+        tables['honey_tokens'].items[access_key_id] = {
+            'AccessKeyID': access_key_id,
+            'CreateTime': 1609459200,
+            'ExpireTime': 0,
+            'Username': "bench-user",
+            'SecretAccessKey': "secret",
+            'Active': True,
+            'Location': "benchmark",
+            'Description': ""
+        }
+    tables['iam_users'].items['bench-user'] = {
+        'Username': "bench-user",
+        'CreateTime': 1609459200,
+        'AccountID': ACCOUNT_ID,
+        'NumTokens': len(honey_key_ids)
+    }
+
+    app_common.dynamodb = LocalDynamoDB(tables.values())
+    app_common.s3 = task_cloudtrail_event.s3 = LocalS3()
+    task_cloudtrail_event.sns = LocalSNS()
+    app_common.HoneyToken.table = tables['honey_tokens']
+    app_common.IAMUser.table = tables['iam_users']
+    app_common.State.table = tables['state']
+
+    return task_cloudtrail_event.s3, task_cloudtrail_event.sns
+
+
+#================================================
+# Benchmark
+#================================================
+def run(args):
+    rng = random.Random(args.seed)
+    access_key_ids = [random_access_key_id(rng) for _ in range(args.distinct_keys)]
+    honey_key_ids = [random_access_key_id(rng) for _ in range(args.honey_keys)]
+    s3, sns = install_stand_ins(honey_key_ids)
+
+    object_keys = []
+    compressed_bytes = 0
+    for i in range(args.files):
+        object_key = "AWSLogs/{0}/CloudTrail/us-east-1/2021/01/01/{0}_CloudTrail_us-east-1_20210101T{1:04d}Z_bench.json.gz".format(
+            ACCOUNT_ID, i)
+        data = generate_cloudtrail_file(
+            rng, args.records, access_key_ids, honey_key_ids, args.hit_ratio, args.record_bytes)
+        s3.objects[('bench-bucket', object_key)] = data
+        object_keys.append(object_key)
+        compressed_bytes += len(data)
+
+    if args.key_filter:
+        app_common.HoneyKeyFilter(honey_key_ids, app_common.State.get_version(
+            app_common.HoneyToken.version_state_id)).publish('bench-bucket')
+        task_cloudtrail_event.token_registry.key_filter_bucket = 'bench-bucket'
+
+    event = {'Records': [{'Sns': {'Message': json.dumps({
+        's3Bucket': "bench-bucket",
+        's3ObjectKey': object_keys
+    })}}]}
+
+    calls.clear()
+    if args.trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = task_cloudtrail_event.main(event, None)
+    elapsed = time.perf_counter() - start
+    if args.trace_memory:
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    num_records = args.files * args.records
+    stats = {
+        'files': args.files,
+        'records': num_records,
+        'compressed_mb': round(compressed_bytes / 1024 / 1024, 2),
+        'honey_events': result['num_honey_events'],
+        'published_messages': len(sns.messages),
+        'seconds': round(elapsed, 3),
+        'records_per_second': round(num_records / elapsed),
+        'api_calls': dict(calls),
+        'api_calls_per_record': round(sum(calls.values()) / num_records, 6),
+    }
+    if args.trace_memory:
+        stats['peak_traced_mb'] = round(peak_bytes / 1024 / 1024, 1)
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CloudTrail event function with synthetic data.")
+    parser.add_argument('--files', type=int, default=10, help="CloudTrail files in the notification.")
+    parser.add_argument('--records', type=int, default=5000, help="Records per file.")
+    parser.add_argument('--record-bytes', type=int, default=1500, help="Approximate JSON size of each record.")
+    parser.add_argument('--distinct-keys', type=int, default=50, help="Distinct non-honey access keys.")
+    parser.add_argument('--honey-keys', type=int, default=5, help="Number of honey tokens.")
+    parser.add_argument('--hit-ratio', type=float, default=0.0005, help="Fraction of records made with a honey key.")
+    parser.add_argument('--key-filter', action='store_true', help="Use a published honey key filter.")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Report peak memory allocated by the handler. Slows the run down.")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
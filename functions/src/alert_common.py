@@ -19,3 +19,44 @@ def parse_sns_event_records(records):
 
 def parse_event_time(time):
     return datetime.datetime.utcfromtimestamp(time).strftime('%Y-%m-%d %H:%M:%S UTC')
+
+
+def format_counts(counts, limit=5, omitted=0):
+    """
+    Format a {value: count} map as "value (count), ..." with the most
+    frequent values first. omitted is the number of values left out of the
+    map already.
+    """
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    text = ", ".join("{} ({})".format(value, count) for value, count in ranked[:limit])
+
+    more = max(len(ranked) - limit, 0) + omitted
+    if more:
+        text += ", and {} more".format(more)
+
+    return text
+
+
+def get_digest_details(message):
+    """
+    Labelled fields of a digest alert, in display order.
+    """
+    digest = message['digest']
+    omitted = digest.get('omitted_values', {})
+    event_count = str(digest['event_count'])
+    if digest['truncated']:
+        event_count += " (not all values are counted below)"
+
+    return [
+        ('Access Key ID', digest['access_key_id']),
+        ('Location', message['token']['location']),
+        ('Description', message['token']['description']),
+        ('Events', event_count),
+        ('First Seen', parse_event_time(digest['first_seen'])),
+        ('Last Seen', parse_event_time(digest['last_seen'])),
+        ('Actions', format_counts(digest['event_names'], omitted=omitted.get('event_names', 0))),
+        ('Regions', format_counts(digest['event_regions'], omitted=omitted.get('event_regions', 0))),
+        ('IP Addresses', format_counts(
+            digest['source_ip_addresses'], omitted=omitted.get('source_ip_addresses', 0))),
+        ('User Agents', format_counts(digest['user_agents'], omitted=omitted.get('user_agents', 0)))
+    ]
@@ -6,6 +6,7 @@ Send an email alert using SES.
 
 import alert_common
 import boto3
+import html
 import json
 import logging
 import os
@@ -16,7 +17,28 @@ logger.setLevel(logging.INFO)
 ses = boto3.client('ses')
 
 
+def get_digest_text(message):
+    return \
+        "An AWS honey token was used repeatedly. " + \
+        "It may have been publicly exposed or its location compromised.\n\n" + \
+        "".join("{}: {}\n".format(label, value) for label, value in alert_common.get_digest_details(message))
+
+
+def get_digest_html(message):
+    return \
+        "<p>An AWS honey token was used repeatedly. " + \
+        "It may have been publicly exposed or its location compromised.</p>\n\n<p>" + \
+        "<br>\n".join(
+            "<b>{}:</b> {}".format(label, html.escape(str(value)))
+            for label, value in alert_common.get_digest_details(message)
+        ) + \
+        "</p>\n"
+
+
 def get_alert_text(message):
+    if 'digest' in message:
+        return get_digest_text(message)
+
     return \
         "An AWS honey token was used. " + \
         "It may have been publicly exposed or its location compromised.\n\n" + \
@@ -31,6 +53,9 @@ def get_alert_text(message):
 
 
 def get_alert_html(message):
+    if 'digest' in message:
+        return get_digest_html(message)
+
     return \
         "<p>An AWS honey token was used. " + \
         "It may have been publicly exposed or its location compromised.</p>\n\n" + \
@@ -33,23 +33,31 @@ def main(event, _context):
         http = urllib3.PoolManager()
         headers = {'Content-Type': "application/json"}
 
+        if 'digest' in message:
+            summary = "AWS Honey Token Alert: {} ({} events)".format(
+                message['digest']['access_key_id'], message['digest']['event_count'])
+            custom_details = dict(alert_common.get_digest_details(message))
+        else:
+            summary = "AWS Honey Token Alert: {}".format(message['event']['access_key_id'])
+            custom_details = {
+                'Access Key ID': message['event']['access_key_id'],
+                'Location': message['token']['location'],
+                'Description': message['token']['description'],
+                'Event Time': alert_common.parse_event_time(message['event']['event_time']),
+                'Action': message['event']['event_name'],
+                'Region': message['event']['event_region'],
+                'IP Address': message['event']['source_ip_address'],
+                'User Agent': message['event']['user_agent']
+            }
+
         body = json.dumps({
             'routing_key': pagerduty_integration_key,
             'event_action': 'trigger',
             'payload': {
-                'summary': "AWS Honey Token Alert: {}".format(message['event']['access_key_id']),
+                'summary': summary,
                 'source': 'aws monitoring',
                 'severity': 'error',
-                'custom_details': {
-                    'Access Key ID': message['event']['access_key_id'],
-                    'Location': message['token']['location'],
-                    'Description': message['token']['description'],
-                    'Event Time': alert_common.parse_event_time(message['event']['event_time']),
-                    'Action': message['event']['event_name'],
-                    'Region': message['event']['event_region'],
-                    'IP Address': message['event']['source_ip_address'],
-                    'User Agent': message['event']['user_agent']
-                }
+                'custom_details': custom_details
             }
         }).encode('utf-8')
 
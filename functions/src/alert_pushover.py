@@ -6,6 +6,7 @@ Send an alert to Pushover via the API.
 
 import alert_common
 import boto3
+import html
 import json
 import logging
 import os
@@ -26,7 +27,20 @@ def get_ssm_parameter(name):
     )['Parameter']['Value']
 
 
+def get_digest_body(message):
+    return \
+        "An AWS honey token was used repeatedly. " + \
+        "It may have been publicly exposed or its location compromised.\n\n" + \
+        "".join(
+            "<b>{}:</b> {}\n".format(label, html.escape(str(value)))
+            for label, value in alert_common.get_digest_details(message)
+        )
+
+
 def get_alert_body(message):
+    if 'digest' in message:
+        return get_digest_body(message)
+
     return \
         "An AWS honey token was used. " + \
         "It may have been publicly exposed or its location compromised.\n\n" + \
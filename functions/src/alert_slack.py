@@ -17,6 +17,83 @@ logger.setLevel(logging.INFO)
 ssm = boto3.client('ssm')
 
 
+def get_digest_blocks(message):
+    return [
+        {
+            'type': "section",
+            'text': {
+                'type': "mrkdwn",
+                'text': "*An AWS honey token was used repeatedly.*\n" +
+                        "It may have been publicly exposed or its location compromised."
+            }
+        },
+        {
+            'type': "divider"
+        },
+        {
+            'type': "section",
+            'text': {
+                'type': "mrkdwn",
+                'text': "\n".join(
+                    "*{}:* {}".format(label, value) for label, value in alert_common.get_digest_details(message)
+                )
+            }
+        },
+        {
+            'type': "divider"
+        }
+    ]
+
+
+def get_alert_blocks(message):
+    if 'digest' in message:
+        return get_digest_blocks(message)
+
+    return [
+        {
+            'type': "section",
+            'text': {
+                'type': "mrkdwn",
+                'text': "*An AWS honey token was used.*\n" +
+                        "It may have been publicly exposed or its location compromised."
+            }
+        },
+        {
+            'type': "divider"
+        },
+        {
+            'type': "section",
+            'text': {
+                'type': "mrkdwn",
+                'text': "*Access Key ID:* {}\n".format(message['event']['access_key_id']) +
+                        "*Location:* {}\n".format(message['token']['location']) +
+                        "*Description:* {}".format(message['token']['description'])
+            }
+        },
+        {
+            'type': "section",
+            'text': {
+                'type': "mrkdwn",
+                'text': "*Event Time:* {}\n"
+                        .format(alert_common.parse_event_time(message['event']['event_time'])) +
+                        "*Action:* {}\n".format(message['event']['event_name']) +
+                        "*Region:* {}".format(message['event']['event_region'])
+            }
+        },
+        {
+            'type': "section",
+            'text': {
+                'type': "mrkdwn",
+                'text': "*IP Address:* {}\n".format(message['event']['source_ip_address']) +
+                        "*User Agent:* {}".format(message['event']['user_agent'])
+            }
+        },
+        {
+            'type': "divider"
+        }
+    ]
+
+
 def main(event, _context):
     logger.info(json.dumps(event))
 
@@ -31,51 +108,7 @@ def main(event, _context):
         http = urllib3.PoolManager()
         headers = {'Content-Type': "application/json"}
 
-        body = json.dumps({
-            'blocks': [
-                {
-                    'type': "section",
-                    'text': {
-                        'type': "mrkdwn",
-                        'text': "*An AWS honey token was used.*\n" +
-                                "It may have been publicly exposed or its location compromised."
-                    }
-                },
-                {
-                    'type': "divider"
-                },
-                {
-                    'type': "section",
-                    'text': {
-                        'type': "mrkdwn",
-                        'text': "*Access Key ID:* {}\n".format(message['event']['access_key_id']) +
-                                "*Location:* {}\n".format(message['token']['location']) +
-                                "*Description:* {}".format(message['token']['description'])
-                    }
-                },
-                {
-                    'type': "section",
-                    'text': {
-                        'type': "mrkdwn",
-                        'text': "*Event Time:* {}\n"
-                                .format(alert_common.parse_event_time(message['event']['event_time'])) +
-                                "*Action:* {}\n".format(message['event']['event_name']) +
-                                "*Region:* {}".format(message['event']['event_region'])
-                    }
-                },
-                {
-                    'type': "section",
-                    'text': {
-                        'type': "mrkdwn",
-                        'text': "*IP Address:* {}\n".format(message['event']['source_ip_address']) +
-                                "*User Agent:* {}".format(message['event']['user_agent'])
-                    }
-                },
-                {
-                    'type': "divider"
-                }
-            ]
-        }).encode('utf-8')
+        body = json.dumps({'blocks': get_alert_blocks(message)}).encode('utf-8')
 
         r = http.request('POST', slack_webhook_url, body=body, headers=headers)
         logger.info(r.data.decode('utf-8'))
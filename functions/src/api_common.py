@@ -5,6 +5,7 @@ Common functions for the application API.
 """
 
 import app_common
+import base64
 import boto3
 import json
 import logging
@@ -29,7 +30,7 @@ def authenticate_user(current_time, key_id, secret_id, provision_key=None):
     if not key_id or not secret_id:
         return {'auth': False, 'admin': False}
 
-    key = app_common.APIKey(key_id)
+    key = app_common.APIKey.get(key_id)
 
     # Fail if not exists, not active, or expired.
     if not key.exists or not key.active or (key.expire_time != 0 and key.expire_time <= current_time):
@@ -71,3 +72,60 @@ def build_response(status_code=200, body=None, headers=None):
         'headers': headers,
         'body': json.dumps(body, cls=app_common.DecimalEncoder)
     }
+
+
+def encode_cursor(position):
+    """
+    Opaque pagination cursor for a position dict, such as a DynamoDB
+    LastEvaluatedKey, or None when there are no more pages.
+    """
+    if position is None:
+        return None
+
+    raw = json.dumps(position, cls=app_common.DecimalEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise Exception("Parameter 'cursor' is not valid.")
+
+    if not isinstance(position, dict):
+        raise Exception("Parameter 'cursor' is not valid.")
+
+    return position
+
+
+def check_fields(body, fields):
+    """
+    Validate the optional 'fields' list and 'summary' flag of a listing
+    request against the output fields it can return.
+    """
+    if not isinstance(body.get('summary', False), bool):
+        raise Exception("Parameter 'summary' must be of type boolean.")
+    if 'fields' not in body:
+        return
+    if body.get('summary'):
+        raise Exception("Parameters 'fields' and 'summary' can not be used together.")
+
+    if not isinstance(body['fields'], list) or not body['fields'] or \
+            not all(isinstance(field, str) for field in body['fields']):
+        raise Exception("Parameter 'fields' must be a non-empty list of strings.")
+
+    unknown = [field for field in body['fields'] if field not in fields]
+    if unknown:
+        raise Exception("Parameter 'fields' has unknown fields: {}.".format(", ".join(unknown)))
+
+
+def get_fields(body, summary_fields):
+    """
+    Output fields requested by a listing, or None for all of them.
+    """
+    if body.get('summary'):
+        return list(summary_fields)
+    if body.get('fields'):
+        return list(dict.fromkeys(body['fields']))
+
+    return None
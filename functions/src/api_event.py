@@ -15,6 +15,9 @@ logger.setLevel(logging.INFO)
 
 current_time = int(time.time())
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 
 def validate_input(event):
     api_common.check_request(event)
@@ -24,6 +27,83 @@ def validate_input(event):
         raise Exception("Parameter 'event_id' must be of type string.")
     if not isinstance(body.get('access_key_id', ""), str):
         raise Exception("Parameter 'access_key_id' must be of type string.")
+    if not isinstance(body.get('limit', 1), int) or not 0 < body.get('limit', 1) <= MAX_PAGE_SIZE:
+        raise Exception("Parameter 'limit' must be an integer between 1 and {}.".format(MAX_PAGE_SIZE))
+    if not isinstance(body.get('start_time', 0), int):
+        raise Exception("Parameter 'start_time' must be of type integer.")
+    if not isinstance(body.get('end_time', 0), int):
+        raise Exception("Parameter 'end_time' must be of type integer.")
+    if body.get('order', "asc") not in ("asc", "desc"):
+        raise Exception("Parameter 'order' must be 'asc' or 'desc'.")
+    if not isinstance(body.get('cursor', ""), str):
+        raise Exception("Parameter 'cursor' must be of type string.")
+    api_common.check_fields(body, app_common.Event.attributes)
+
+
+def check_position(position, access_key_id):
+    """
+    Validate a decoded cursor: {'Key': ...} for a position in the events
+    table, or {'ArchiveDate': ..., 'Offset': ...} for one in the archive.
+    """
+    if set(position) == {'Key'}:
+        key = position['Key']
+        if key is None:
+            return
+        if not isinstance(key, dict) or set(key) != {'EventID', 'AccessKeyID', 'EventTime'}:
+            raise Exception("Parameter 'cursor' is not valid.")
+        if key['AccessKeyID'] != access_key_id:
+            raise Exception("Parameter 'cursor' does not match 'access_key_id'.")
+    elif set(position) == {'ArchiveDate', 'Offset'}:
+        if not isinstance(position['ArchiveDate'], (str, type(None))) or not isinstance(position['Offset'], int):
+            raise Exception("Parameter 'cursor' is not valid.")
+    else:
+        raise Exception("Parameter 'cursor' is not valid.")
+
+
+def get_events_page(access_key_id, limit, start_time, end_time, ascending, position, fields=None):
+    """
+    One page of a token's events. Events before the archive's
+    ArchivedThrough mark are read from S3 and the rest from the events
+    table; ascending pages walk the archive first, descending pages the
+    table first. Returns the events, cut down to the given fields, and the
+    position of the next page, or None after the last page.
+    """
+    archived_through = app_common.EventArchive.get_archived_through()
+    in_archive = archived_through > 0 and (start_time is None or start_time < archived_through)
+    in_table = end_time is None or end_time >= archived_through
+
+    if position is None:
+        if in_archive and (ascending or not in_table):
+            position = {'ArchiveDate': None, 'Offset': 0}
+        else:
+            position = {'Key': None}
+
+    if 'Key' in position:
+        events, key = app_common.Event.get_events_for_token(
+            access_key_id,
+            limit=limit,
+            start_time=max(start_time or 0, archived_through) or None,
+            end_time=end_time,
+            ascending=ascending,
+            exclusive_start_key=position['Key'],
+            fields=fields
+        )
+        if key is not None:
+            return events, {'Key': key}
+        if in_archive and not ascending:
+            return events, {'ArchiveDate': None, 'Offset': 0}
+        return events, None
+
+    events, archive_position = app_common.EventArchive.get_events(
+        access_key_id, archived_through, limit, start_time, end_time, ascending,
+        position['ArchiveDate'], position['Offset'])
+    if fields:
+        events = [{field: event.get(field) for field in fields} for event in events]
+    if archive_position is not None:
+        return events, {'ArchiveDate': archive_position[0], 'Offset': archive_position[1]}
+    if in_table and ascending:
+        return events, {'Key': None}
+    return events, None
 
 
 def get_request(body):
@@ -32,31 +112,77 @@ def get_request(body):
 
     if body.get('event_id'):
         # Fetch single event
-        event = app_common.Event(body['event_id'])
+        event = app_common.Event.get(body['event_id'])
 
         if not event.exists:
             return api_common.build_response(404, {'error': "Event not found."})
 
         return api_common.build_response(200, {'event': event.get_dict()})
 
-    # Fetch all events for token
-    token = app_common.HoneyToken(body['access_key_id'])
+    # Fetch a page of events for token
+    token = app_common.HoneyToken.get(body['access_key_id'])
     if not token.exists:
         return api_common.build_response(404, {'error': "Token not found."})
 
-    events = app_common.Event.get_all_events_for_token(body['access_key_id'])
+    position = None
+    if body.get('cursor'):
+        try:
+            position = api_common.decode_cursor(body['cursor'])
+            check_position(position, body['access_key_id'])
+        except Exception as e:
+            return api_common.build_response(400, {'error': str(e)})
+
+    events, position = get_events_page(
+        body['access_key_id'],
+        limit=body.get('limit', DEFAULT_PAGE_SIZE),
+        start_time=body.get('start_time'),
+        end_time=body.get('end_time'),
+        ascending=body.get('order', "asc") == "asc",
+        position=position,
+        fields=api_common.get_fields(body, app_common.Event.summary_fields)
+    )
     response = {
         'count': len(events),
         'access_key_id': body['access_key_id'],
-        'events': events
+        'events': events,
+        'cursor': api_common.encode_cursor(position)
     }
     return api_common.build_response(200, response)
 
 
+def get_stats_request(body):
+    if not body.get('access_key_id'):
+        return api_common.build_response(400, {'error': "Must specify 'access_key_id'."})
+
+    token = app_common.HoneyToken.get(body['access_key_id'])
+    if not token.exists:
+        return api_common.build_response(404, {'error': "Token not found."})
+
+    item = app_common.EventStats.get_item(body['access_key_id'])
+    if item is None:
+        stats = {
+            'access_key_id': body['access_key_id'],
+            'event_count': 0,
+            'first_seen': None,
+            'last_seen': None,
+            'days': {},
+            'event_names': {},
+            'event_regions': {},
+            'source_ip_addresses': {},
+            'user_agents': {},
+            'truncated': False
+        }
+    else:
+        stats = app_common.EventStats.get_dict(item)
+
+    return api_common.build_response(200, {'stats': stats})
+
+
 def main(event, _context):
-    request_method = event['requestContext']['http']['method']
     headers = event.get('headers', {})
 
+    app_common.identity_map.clear()
+
     # Authentication
     auth = api_common.authenticate_user(
         current_time, headers.get('x-key-id'), headers.get('x-secret-id'))
@@ -72,9 +198,10 @@ def main(event, _context):
     body = json.loads(event.get('body', "{}"))
 
     # Routing
-    methods = {
-        'GET': get_request
+    routes = {
+        'GET /event': get_request,
+        'GET /event/stats': get_stats_request
     }
 
     # Response
-    return methods[request_method](body)
+    return routes[event['routeKey']](body)
@@ -27,7 +27,7 @@ def validate_input(event):
 def get_request(body):
     if body.get('key_id'):
         # Fetch single key
-        key = app_common.APIKey(body['key_id'])
+        key = app_common.APIKey.get(body['key_id'])
 
         if not key.exists:
             return api_common.build_response(404, {'error': "Key not found."})
@@ -69,7 +69,7 @@ def patch_request(body):
     if 'key_id' not in body:
         return api_common.build_response(400, {'error': "Parameter 'key_id' is required."})
 
-    key = app_common.APIKey(body['key_id'])
+    key = app_common.APIKey.get(body['key_id'])
     if not key.exists:
         return api_common.build_response(404, {'error': "Key not found."})
 
@@ -91,7 +91,7 @@ def delete_request(body):
     if 'key_id' not in body:
         return api_common.build_response(400, {'error': "Parameter 'key_id' is required."})
 
-    key = app_common.APIKey(body['key_id'])
+    key = app_common.APIKey.get(body['key_id'])
     if not key.exists:
         return api_common.build_response(404, {'error': "Key not found."})
 
@@ -103,6 +103,8 @@ def main(event, _context):
     request_method = event['requestContext']['http']['method']
     headers = event.get('headers', {})
 
+    app_common.identity_map.clear()
+
     # Authentication w/ admin
     provision_key = headers.get('x-provision-key') if request_method == "POST" else None
     auth = api_common.authenticate_user(
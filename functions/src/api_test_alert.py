@@ -74,6 +74,8 @@ def main(event, _context):
     request_method = event['requestContext']['http']['method']
     headers = event.get('headers', {})
 
+    app_common.identity_map.clear()
+
     # Authentication
     auth = api_common.authenticate_user(
         current_time, headers.get('x-key-id'), headers.get('x-secret-id'))
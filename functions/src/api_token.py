@@ -8,6 +8,7 @@ import app_common
 import api_common
 import json
 import logging
+import os
 import time
 
 logger = logging.getLogger()
@@ -15,6 +16,9 @@ logger.setLevel(logging.INFO)
 
 current_time = int(time.time())
 
+# Keeps a bulk request well inside API Gateway's 30 second timeout.
+MAX_BULK_TOKENS = 100
+
 
 def validate_input(event):
     api_common.check_request(event)
@@ -22,12 +26,33 @@ def validate_input(event):
     body = json.loads(event.get('body', "{}"))
     if not isinstance(body.get('access_key_id', ""), str):
         raise Exception("Parameter 'access_key_id' must be of type string.")
+    api_common.check_fields(body, app_common.HoneyToken.attributes)
+
+    if event['routeKey'] == 'POST /token/bulk':
+        tokens = body.get('tokens', [])
+        if not isinstance(tokens, list) or not all(isinstance(settings, dict) for settings in tokens):
+            raise Exception("Parameter 'tokens' must be a list of objects.")
+        count = body.get('count', len(tokens))
+        if not isinstance(count, int) or not 0 < count <= MAX_BULK_TOKENS:
+            raise Exception("Parameter 'count' must be an integer between 1 and {}.".format(MAX_BULK_TOKENS))
+        if len(tokens) > count:
+            raise Exception("Parameter 'tokens' must not have more entries than 'count'.")
+
+
+def publish_key_filter():
+    """
+    Rebuild the honey key filter read by the CloudTrail function after the
+    set of tokens has changed.
+    """
+    bucket = os.environ.get('HONEY_KEY_FILTER_BUCKET')
+    if bucket:
+        app_common.HoneyKeyFilter.build().publish(bucket)
 
 
 def get_request(body):
     if body.get('access_key_id'):
         # Fetch single token
-        token = app_common.HoneyToken(body['access_key_id'])
+        token = app_common.HoneyToken.get(body['access_key_id'])
 
         if not token.exists:
             return api_common.build_response(404, {'error': "Honey token not found."})
@@ -35,7 +60,8 @@ def get_request(body):
         return api_common.build_response(200, {'token': token.get_dict()})
 
     # Fetch all tokens
-    tokens = app_common.HoneyToken.get_all_tokens()
+    tokens = app_common.HoneyToken.get_all_tokens(
+        fields=api_common.get_fields(body, app_common.HoneyToken.summary_fields))
     response = {'count': len(tokens), 'tokens': tokens}
     return api_common.build_response(200, response)
 
@@ -44,26 +70,40 @@ def post_request(body):
     token = app_common.HoneyToken()
 
     try:
-        token.generate()
+        token.generate(body)
     except Exception as e:
         return api_common.build_response(429, {'error': str(e)})
 
-    if body:
-        token.set_expire_time(body.get('expire_time'))
-        token.set_active(body.get('active'))
-        token.set_location(body.get('location'))
-        token.set_description(body.get('description'))
-
-    token.save()
+    publish_key_filter()
 
     return api_common.build_response(200, token.get_dict())
 
 
+def post_bulk_request(body):
+    tokens = body.get('tokens', [])
+    count = body.get('count', len(tokens))
+    settings = tokens + [{}] * (count - len(tokens))
+
+    results = []
+    for result in app_common.HoneyToken.generate_many(settings):
+        if isinstance(result, Exception):
+            results.append({'error': str(result)})
+        else:
+            results.append({'token': result.get_dict()})
+
+    created = sum(1 for result in results if 'token' in result)
+    if created:
+        publish_key_filter()
+
+    response = {'count': created, 'failed': len(results) - created, 'results': results}
+    return api_common.build_response(200, response)
+
+
 def patch_request(body):
     if 'access_key_id' not in body:
         return api_common.build_response(400, {'error': "Parameter 'access_key_id' is required."})
 
-    token = app_common.HoneyToken(body['access_key_id'])
+    token = app_common.HoneyToken.get(body['access_key_id'])
     if not token.exists:
         return api_common.build_response(404, {'error': "Honey token not found."})
 
@@ -77,6 +117,7 @@ def patch_request(body):
         token.set_description(body['description'])
 
     token.save()
+    publish_key_filter()
 
     return api_common.build_response(200, {'key': token.get_dict()})
 
@@ -85,18 +126,21 @@ def delete_request(body):
     if 'access_key_id' not in body:
         return api_common.build_response(400, {'error': "Parameter 'access_key_id' is required."})
 
-    token = app_common.HoneyToken(body['access_key_id'])
+    token = app_common.HoneyToken.get(body['access_key_id'])
     if not token.exists:
         return api_common.build_response(404, {'error': "Honey token not found."})
 
     token.delete()
+    publish_key_filter()
+
     return api_common.build_response(204)
 
 
 def main(event, _context):
-    request_method = event['requestContext']['http']['method']
     headers = event.get('headers', {})
 
+    app_common.identity_map.clear()
+
     # Authentication
     auth = api_common.authenticate_user(
         current_time, headers.get('x-key-id'), headers.get('x-secret-id'))
@@ -112,12 +156,13 @@ def main(event, _context):
     body = json.loads(event.get('body', "{}"))
 
     # Routing
-    methods = {
-        'GET': get_request,
-        'POST': post_request,
-        'PATCH': patch_request,
-        'DELETE': delete_request,
+    routes = {
+        'GET /token': get_request,
+        'POST /token': post_request,
+        'POST /token/bulk': post_bulk_request,
+        'PATCH /token': patch_request,
+        'DELETE /token': delete_request,
     }
 
     # Response
-    return methods[request_method](body)
+    return routes[event['routeKey']](body)
@@ -5,13 +5,20 @@ Common classes and functions for the whole application.
 """
 
 import boto3
+import boto3.dynamodb.conditions
+import boto3.dynamodb.types
 import base64
+import concurrent.futures
+import datetime
 import decimal
+import gzip
 import hashlib
 import json
 import logging
 import os
+import random
 import secrets
+import struct
 import time
 import uuid
 
@@ -19,9 +26,150 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 dynamodb = boto3.resource('dynamodb')
+# Requests made from worker threads go through this low-level client, as
+# resources are not thread safe. Unlike a resource's meta.client, it does not
+# serialize values itself, so they are passed as DynamoDB JSON built with
+# TypeSerializer.
+dynamodb_client = boto3.client('dynamodb')
 iam = boto3.client('iam')
+s3 = boto3.client('s3')
 sts = boto3.client('sts')
 
+# DynamoDB BatchGetItem accepts at most 100 keys per request, and
+# BatchWriteItem at most 25 requests.
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+BATCH_RETRY_LIMIT = 8
+BATCH_DELETE_CONCURRENCY = 4
+
+# Parallel IAM calls when creating tokens in bulk, kept low to stay under
+# IAM's request rate limits.
+IAM_CONCURRENCY = 4
+
+# Users with free slots tried per token before creating a new user.
+CANDIDATE_USERS = 10
+
+# How long events stay in the events table after leaving the hot window.
+EVENT_EXPIRE_MARGIN = 7 * 86400
+
+
+account_id = None
+
+
+def get_account_id():
+    """
+    The AWS account ID, looked up with STS once per container.
+    """
+    global account_id
+
+    if account_id is None:
+        account_id = sts.get_caller_identity()['Account']
+
+    return account_id
+
+
+class IdentityMap:
+    """
+    Model objects read during one invocation, keyed by class and primary key,
+    so the same item is only fetched once. Lambda keeps module state between
+    warm invocations, so handlers clear it when they start.
+    """
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, cls, key):
+        if (cls, key) not in self.objects:
+            self.objects[(cls, key)] = cls(key)
+
+        return self.objects[(cls, key)]
+
+    def clear(self):
+        self.objects = {}
+
+
+identity_map = IdentityMap()
+
+
+def batch_get_items(table, keys, consistent_read=False):
+    """
+    Fetch many items from a table with BatchGetItem, in chunks of 100 keys.
+    Unprocessed keys are retried with exponential backoff.
+    """
+    items = []
+
+    for i in range(0, len(keys), BATCH_GET_SIZE):
+        request = {table.name: {
+            'Keys': keys[i:i + BATCH_GET_SIZE],
+            'ConsistentRead': consistent_read
+        }}
+
+        for attempt in range(BATCH_RETRY_LIMIT):
+            response = dynamodb.batch_get_item(RequestItems=request)
+            items.extend(response.get('Responses', {}).get(table.name, []))
+
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+
+            time.sleep(min(0.05 * 2 ** attempt, 2))
+        else:
+            raise Exception("Unprocessed keys remain after {} BatchGetItem attempts.".format(BATCH_RETRY_LIMIT))
+
+    return items
+
+
+def batch_delete_items(table, keys):
+    """
+    Delete up to 25 items from a table with one BatchWriteItem request,
+    through dynamodb_client. Unprocessed deletes are retried with
+    exponential backoff.
+    """
+    serializer = boto3.dynamodb.types.TypeSerializer()
+    request = {table.name: [
+        {'DeleteRequest': {'Key': {name: serializer.serialize(value) for name, value in key.items()}}}
+        for key in keys
+    ]}
+
+    for attempt in range(BATCH_RETRY_LIMIT):
+        response = dynamodb_client.batch_write_item(RequestItems=request)
+
+        request = response.get('UnprocessedItems')
+        if not request:
+            return
+
+        time.sleep(min(0.05 * 2 ** attempt, 2))
+
+    raise Exception("Unprocessed items remain after {} BatchWriteItem attempts.".format(BATCH_RETRY_LIMIT))
+
+
+def get_projection_args(fields, attributes):
+    """
+    ProjectionExpression arguments that read only the attributes behind the
+    given output fields. `attributes` maps each output field to its
+    attribute name and conversion, as in Event.attributes.
+    """
+    names = {'#p{}'.format(i): attributes[field][0] for i, field in enumerate(fields)}
+    return {
+        'ProjectionExpression': ", ".join(names),
+        'ExpressionAttributeNames': names
+    }
+
+
+def get_fields_dict(item, fields, attributes):
+    """
+    Output dict of the given fields of an item. Attributes missing from the
+    item come out as None.
+    """
+    fields_dict = {}
+    for field in fields:
+        attribute, convert = attributes[field]
+        if convert and attribute in item:
+            fields_dict[field] = convert(item[attribute])
+        else:
+            fields_dict[field] = item.get(attribute)
+
+    return fields_dict
+
 
 class APIKey:
     table = dynamodb.Table("{}-api-keys".format(os.environ['APP_NAME']))
@@ -48,6 +196,13 @@ class APIKey:
 
         return keys
 
+    @classmethod
+    def get(cls, key_id):
+        """
+        The key from the invocation's identity map, read on first use.
+        """
+        return identity_map.get(cls, key_id)
+
     # This functionality was rejected in favor of maintaining expired keys
     # for restoration later.
     # @classmethod
@@ -205,12 +360,30 @@ class APIKey:
 
 class Event:
     table = dynamodb.Table("{}-events".format(os.environ['APP_NAME']))
+    # Hot retention window in seconds; 0 keeps events in the table forever.
+    retention = int(os.environ.get('EVENT_RETENTION', 0))
+    # Output field: (attribute, conversion)
+    attributes = {
+        'event_id': ('EventID', None),
+        'access_key_id': ('AccessKeyID', None),
+        'alerted': ('Alerted', bool),
+        'event_name': ('EventName', None),
+        'event_region': ('EventRegion', None),
+        'event_time': ('EventTime', int),
+        'request_parameters': ('RequestParameters', None),
+        'source_ip_address': ('SourceIPAddress', None),
+        'user_agent': ('UserAgent', None)
+    }
+    # Fields for listings that leave out the bulky request details.
+    summary_fields = ('event_id', 'alerted', 'event_name', 'event_region', 'event_time', 'source_ip_address')
 
     @classmethod
-    def get_should_alert_next(cls, access_key_id, event_time, cooldown):
-        if cooldown == 0:
-            return True
-
+    def get_last_alert_time(cls, access_key_id, event_time, cooldown):
+        """
+        Latest EventTime of an alerted event for the token that could still
+        suppress an alert at event_time, or None. A cooldown of -1 looks at
+        all events for the token.
+        """
         key_conditions = {
             'AccessKeyID': {
                 'AttributeValueList': [access_key_id],
@@ -225,77 +398,157 @@ class Event:
                 }
             })
 
-        num_recent_events = cls.table.query(
-            IndexName='AccessKeyID-EventTime',
-            Select='COUNT',
-            KeyConditions=key_conditions,
-            QueryFilter={
+        query_args = {
+            'IndexName': 'AccessKeyID-EventTime',
+            'Select': 'SPECIFIC_ATTRIBUTES',
+            'AttributesToGet': ['EventTime'],
+            'KeyConditions': key_conditions,
+            'QueryFilter': {
                 'Alerted': {
                     'AttributeValueList': [True],
                     'ComparisonOperator': 'EQ'
                 }
             }
-        )
-
-        return num_recent_events['Count'] == 0
-
-    @classmethod
-    def get_all_events_for_token(cls, access_key_id):
-        response = cls.table.query(
-            IndexName='AccessKeyID-EventTime',
-            Select='ALL_ATTRIBUTES',
-            KeyConditions={'AccessKeyID': {
-                'AttributeValueList': [access_key_id],
-                'ComparisonOperator': 'EQ'
-            }}
-        )
+        }
+        response = cls.table.query(**query_args)
         items = response.get('Items', [])
 
         while response.get('LastEvaluatedKey') is not None:
-            response = cls.table.query(
-                IndexName='AccessKeyID-EventTime',
-                Select='ALL_ATTRIBUTES',
-                KeyConditions={'AccessKeyID': {
-                    'AttributeValueList': [access_key_id],
-                    'ComparisonOperator': 'EQ'
-                }}
-            )
+            response = cls.table.query(ExclusiveStartKey=response['LastEvaluatedKey'], **query_args)
             items.extend(response.get('Items', []))
 
-        events = []
-        for item in items:
-            events.append({
-                'event_id': item['EventID'],
-                'access_key_id': item['AccessKeyID'],
-                'alerted': bool(item['Alerted']),
-                'event_name': item['EventName'],
-                'event_region': item['EventRegion'],
-                'event_time': int(item['EventTime']),
-                'request_parameters': item.get('RequestParameters'),
-                'source_ip_address': item['SourceIPAddress'],
-                'user_agent': item['UserAgent']
-            })
+        return max((int(item['EventTime']) for item in items), default=None)
 
-        return events
+    @classmethod
+    def get(cls, event_id):
+        """
+        The event from the invocation's identity map, read on first use.
+        """
+        return identity_map.get(cls, event_id)
+
+    @classmethod
+    def save_events(cls, events):
+        """
+        Write many events with a batch writer.
+        """
+        with cls.table.batch_writer(overwrite_by_pkeys=['EventID']) as batch:
+            for event in events:
+                batch.put_item(Item=event.__get_item())
+                event.exists = True
+
+    @staticmethod
+    def __get_key_condition(access_key_id, start_time=None, end_time=None):
+        key = boto3.dynamodb.conditions.Key
+        key_condition = key('AccessKeyID').eq(access_key_id)
+
+        if start_time is not None and end_time is not None:
+            key_condition &= key('EventTime').between(int(start_time), int(end_time))
+        elif start_time is not None:
+            key_condition &= key('EventTime').gte(int(start_time))
+        elif end_time is not None:
+            key_condition &= key('EventTime').lte(int(end_time))
+
+        return key_condition
+
+    @classmethod
+    def get_events_for_token(cls, access_key_id, limit=None, start_time=None, end_time=None,
+                             ascending=True, exclusive_start_key=None, fields=None):
+        """
+        One page of a token's events from the AccessKeyID-EventTime index,
+        optionally bounded by event time (inclusive). Returns the events and
+        the key to continue from, which is None on the last page. Given a
+        list of output fields, only their attributes are read.
+        """
+        query_args = {
+            'IndexName': 'AccessKeyID-EventTime',
+            'Select': 'ALL_ATTRIBUTES',
+            'KeyConditionExpression': cls.__get_key_condition(access_key_id, start_time, end_time),
+            'ScanIndexForward': ascending
+        }
+        if fields:
+            query_args.update(get_projection_args(fields, cls.attributes))
+            query_args['Select'] = 'SPECIFIC_ATTRIBUTES'
+        if limit:
+            query_args['Limit'] = limit
+        if exclusive_start_key:
+            query_args['ExclusiveStartKey'] = exclusive_start_key
 
+        response = cls.table.query(**query_args)
+        events = [cls.get_item_dict(item, fields) for item in response.get('Items', [])]
+
+        return events, response.get('LastEvaluatedKey')
 
     @classmethod
-    def delete_events_for_token(cls, access_key_id):
-        events = cls.table.query(
-            IndexName='AccessKeyID-EventTime',
-            Select='SPECIFIC_ATTRIBUTES',
-            AttributesToGet=[
-                'EventID'
-            ],
-            KeyConditions={'AccessKeyID': {
+    def iter_items_for_token(cls, access_key_id, start_time=None, end_time=None):
+        """
+        Yield all of a token's raw event items in event time order,
+        optionally bounded by event time (inclusive).
+        """
+        query_args = {
+            'IndexName': 'AccessKeyID-EventTime',
+            'Select': 'ALL_ATTRIBUTES',
+            'KeyConditionExpression': cls.__get_key_condition(access_key_id, start_time, end_time)
+        }
+
+        while True:
+            response = cls.table.query(**query_args)
+            yield from response.get('Items', [])
+
+            if 'LastEvaluatedKey' not in response:
+                return
+
+            query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    @classmethod
+    def get_all_events_for_token(cls, access_key_id, start_time=None, end_time=None):
+        return [cls.get_item_dict(item) for item in cls.iter_items_for_token(access_key_id, start_time, end_time)]
+
+    @classmethod
+    def delete_events_for_token(cls, access_key_id, concurrency=BATCH_DELETE_CONCURRENCY):
+        """
+        Delete all of a token's events. Event IDs are paged from the
+        AccessKeyID-EventTime index and deleted in BatchWriteItem chunks of
+        25, with up to `concurrency` chunks in flight while the next page is
+        read. Returns the number of events deleted.
+        """
+        query_args = {
+            'IndexName': 'AccessKeyID-EventTime',
+            'Select': 'SPECIFIC_ATTRIBUTES',
+            'AttributesToGet': ['EventID'],
+            'KeyConditions': {'AccessKeyID': {
                 'AttributeValueList': [access_key_id],
                 'ComparisonOperator': 'EQ'
             }}
-        )
+        }
+        deleted = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = set()
+
+            while True:
+                response = cls.table.query(**query_args)
+                keys = [{'EventID': item['EventID']} for item in response.get('Items', [])]
+
+                for i in range(0, len(keys), BATCH_WRITE_SIZE):
+                    if len(pending) >= concurrency * 2:
+                        done, pending = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+
+                    pending.add(executor.submit(batch_delete_items, cls.table, keys[i:i + BATCH_WRITE_SIZE]))
+
+                deleted += len(keys)
 
-        for item in events.get('Items', []):
-            event = Event(item['EventID'])
-            event.delete()
+                if 'LastEvaluatedKey' not in response:
+                    break
+
+                query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+            for future in concurrent.futures.as_completed(pending):
+                future.result()
+
+        return deleted
 
     def __init__(self, event_id=None):
         self.exists = False
@@ -329,8 +582,8 @@ class Event:
         self.source_ip_address = item.get('SourceIPAddress')
         self.user_agent = item.get('UserAgent')
 
-    def __write(self):
-        self.table.put_item(Item={
+    def __get_item(self):
+        item = {
             'EventID': self.event_id,
             'AccessKeyID': self.access_key_id,
             'Alerted': self.alerted,
@@ -340,7 +593,17 @@ class Event:
             'RequestParameters': self.request_parameters,
             'SourceIPAddress': self.source_ip_address,
             'UserAgent': self.user_agent
-        })
+        }
+
+        # Expire by TTL once past the hot window, leaving the archive task
+        # time to copy the event to S3 first.
+        if self.retention:
+            item['ExpireTime'] = int(self.event_time) + self.retention + EVENT_EXPIRE_MARGIN
+
+        return item
+
+    def __write(self):
+        self.table.put_item(Item=self.__get_item())
         self.exists = True
 
     def __delete(self):
@@ -356,6 +619,10 @@ class Event:
         self.source_ip_address = None
         self.user_agent = None
 
+    @classmethod
+    def get_item_dict(cls, item, fields=None):
+        return get_fields_dict(item, fields or cls.attributes, cls.attributes)
+
     def get_dict(self):
         return {
             'event_id': self.event_id,
@@ -379,28 +646,99 @@ class Event:
 
 class HoneyToken:
     table = dynamodb.Table("{}-honey-tokens".format(os.environ['APP_NAME']))
+    version_state_id = "honey-tokens-version"
+    # Output field: (attribute, conversion)
+    attributes = {
+        'access_key_id': ('AccessKeyID', None),
+        'create_time': ('CreateTime', int),
+        'expire_time': ('ExpireTime', int),
+        'username': ('Username', None),
+        'secret_access_key': ('SecretAccessKey', None),
+        'active': ('Active', bool),
+        'location': ('Location', None),
+        'description': ('Description', None)
+    }
+    # Fields for listings that leave out the secret.
+    summary_fields = ('access_key_id', 'create_time', 'expire_time', 'username', 'active', 'location', 'description')
 
     @classmethod
-    def get_all_tokens(cls):
-        response = cls.table.scan()
+    def get_all_tokens(cls, fields=None):
+        """
+        Scan for all tokens as output dicts. Given a list of output fields,
+        only their attributes are read.
+        """
+        scan_args = get_projection_args(fields, cls.attributes) if fields else {}
+        response = cls.table.scan(**scan_args)
         items = response.get('Items', [])
 
         while response.get('LastEvaluatedKey') is not None:
-            response = cls.table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
+            response = cls.table.scan(ExclusiveStartKey=response['LastEvaluatedKey'], **scan_args)
             items.extend(response.get('Items', []))
 
-        tokens = []
+        return [get_fields_dict(item, fields or cls.attributes, cls.attributes) for item in items]
+
+    @classmethod
+    def get(cls, access_key_id):
+        """
+        The token from the invocation's identity map, read on first use.
+        """
+        return identity_map.get(cls, access_key_id)
+
+    @classmethod
+    def get_tokens(cls, access_key_ids):
+        """
+        Look up many tokens at once. Returns a dict of access key ID to
+        HoneyToken for the keys that exist; unknown keys are left out.
+        """
+        keys = [{'AccessKeyID': access_key_id} for access_key_id in set(access_key_ids)]
+        items = batch_get_items(cls.table, keys)
+        return cls.__from_items(items)
+
+    @classmethod
+    def get_active_tokens(cls):
+        """
+        Scan for all tokens marked active. Returns a dict of access key ID to
+        HoneyToken.
+        """
+        scan_filter = {'Active': {
+            'AttributeValueList': [True],
+            'ComparisonOperator': 'EQ'
+        }}
+        response = cls.table.scan(ScanFilter=scan_filter)
+        items = response.get('Items', [])
+
+        while response.get('LastEvaluatedKey') is not None:
+            response = cls.table.scan(ScanFilter=scan_filter, ExclusiveStartKey=response['LastEvaluatedKey'])
+            items.extend(response.get('Items', []))
+
+        return cls.__from_items(items)
+
+    @classmethod
+    def get_active_access_key_ids(cls):
+        scan_args = {
+            'AttributesToGet': ['AccessKeyID'],
+            'ScanFilter': {'Active': {
+                'AttributeValueList': [True],
+                'ComparisonOperator': 'EQ'
+            }}
+        }
+        response = cls.table.scan(**scan_args)
+        items = response.get('Items', [])
+
+        while response.get('LastEvaluatedKey') is not None:
+            response = cls.table.scan(ExclusiveStartKey=response['LastEvaluatedKey'], **scan_args)
+            items.extend(response.get('Items', []))
+
+        return [item['AccessKeyID'] for item in items]
+
+    @classmethod
+    def __from_items(cls, items):
+        tokens = {}
         for item in items:
-            tokens.append({
-                'access_key_id': item['AccessKeyID'],
-                'create_time': int(item['CreateTime']),
-                'expire_time': int(item['ExpireTime']),
-                'username': item['Username'],
-                'secret_access_key': item['SecretAccessKey'],
-                'active': bool(item['Active']),
-                'location': item['Location'],
-                'description': item['Description']
-            })
+            token = HoneyToken()
+            token.access_key_id = item['AccessKeyID']
+            token.__load(item)
+            tokens[token.access_key_id] = token
 
         return tokens
 
@@ -434,37 +772,173 @@ class HoneyToken:
         if access_key_id:
             self.__read()
 
+    @property
+    def user(self):
+        # Read on first use, as most callers never look at the user. Loaded
+        # users are not kept on the token, which the honey token registry
+        # may hold across invocations, so each invocation reads its own.
+        if self.__user is None and self.username:
+            return IAMUser.get(self.username)
+
+        return self.__user
+
+    @user.setter
+    def user(self, user):
+        self.__user = user
+        self.username = user.username if user is not None else None
+
     def __read(self):
         response = self.table.get_item(Key={'AccessKeyID': self.access_key_id})
 
         if 'Item' not in response:
             return
 
-        item = response['Item']
+        self.__load(response['Item'])
+
+    def __load(self, item):
         self.exists = True
         self.create_time = item.get('CreateTime', None)
         self.expire_time = item.get('ExpireTime', None)
-        self.user = IAMUser(item.get('Username', None))
+        self.user = None
+        self.username = item.get('Username', None)
         self.secret_access_key = item.get('SecretAccessKey', None)
         self.active = item.get('Active', None)
         self.location = item.get('Location', None)
         self.description = item.get('Description', None)
 
-    def __write(self):
-        self.table.put_item(Item={
+    def __get_item(self):
+        return {
             'AccessKeyID': self.access_key_id,
             'CreateTime': self.create_time,
             'ExpireTime': self.expire_time,
-            'Username': self.user.username,
+            'Username': self.username,
             'SecretAccessKey': self.secret_access_key,
             'Active': self.active,
             'Location': self.location,
             'Description': self.description
-        })
+        }
+
+    def __write(self):
+        self.table.put_item(Item=self.__get_item())
+        self.exists = True
+        State.bump_version(self.version_state_id)
+
+    def __get_claim_transaction(self):
+        """
+        TransactWriteItems actions that take a slot on the token's user and
+        save the token together.
+        """
+        serializer = boto3.dynamodb.types.TypeSerializer()
+        return [
+            {'Update': {
+                'TableName': IAMUser.table.name,
+                'Key': {'Username': serializer.serialize(self.username)},
+                'UpdateExpression': "ADD NumTokens :one",
+                'ConditionExpression': "attribute_exists(Username) AND NumTokens < :max_tokens",
+                'ExpressionAttributeValues': {
+                    ':one': serializer.serialize(1),
+                    ':max_tokens': serializer.serialize(IAMUser.max_tokens)
+                }
+            }},
+            {'Put': {
+                'TableName': self.table.name,
+                'Item': {name: serializer.serialize(value) for name, value in self.__get_item().items()},
+                'ConditionExpression': "attribute_not_exists(AccessKeyID)"
+            }}
+        ]
+
+    def __get_release_transaction(self):
+        """
+        TransactWriteItems actions that delete the token and free its slot
+        on the user together.
+        """
+        serializer = boto3.dynamodb.types.TypeSerializer()
+        return [
+            {'Delete': {
+                'TableName': self.table.name,
+                'Key': {'AccessKeyID': serializer.serialize(self.access_key_id)}
+            }},
+            {'Update': {
+                'TableName': IAMUser.table.name,
+                'Key': {'Username': serializer.serialize(self.username)},
+                'UpdateExpression': "ADD NumTokens :minus_one",
+                'ConditionExpression': "NumTokens > :zero",
+                'ExpressionAttributeValues': {
+                    ':minus_one': serializer.serialize(-1),
+                    ':zero': serializer.serialize(0)
+                }
+            }}
+        ]
+
+    def __claim_slot(self, user, access_key):
+        """
+        Save a new token for an access key just created on the user, taking
+        one of the user's slots. Safe to call from threads. Returns False if
+        the user had no free slot left. Unless the slot is claimed, the
+        access key is deleted again, whatever went wrong.
+        """
+        self.user = user
+        self.access_key_id = access_key['AccessKeyId']
+        self.secret_access_key = access_key['SecretAccessKey']
+
+        try:
+            claimed = self.__transact_claim()
+        except Exception:
+            iam.delete_access_key(UserName=user.username, AccessKeyId=self.access_key_id)
+            raise
+
+        if not claimed:
+            iam.delete_access_key(UserName=user.username, AccessKeyId=self.access_key_id)
+            return False
+
         self.exists = True
+        return True
+
+    def __transact_claim(self):
+        """
+        Run the claim transaction. One cancelled only because another was
+        writing the same user at the same moment is retried with exponential
+        backoff. Returns False if the slot was lost to another request.
+        """
+        for attempt in range(BATCH_RETRY_LIMIT):
+            if attempt:
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+
+            try:
+                dynamodb_client.transact_write_items(TransactItems=self.__get_claim_transaction())
+            except dynamodb_client.exceptions.TransactionCanceledException as e:
+                codes = {reason.get('Code') for reason in e.response.get('CancellationReasons', [])}
+                if codes <= {'None', 'TransactionConflict'}:
+                    continue
+
+                # Lost the slot to another request; anything else is an error.
+                if codes <= {'None', 'ConditionalCheckFailed', 'TransactionConflict'}:
+                    return False
+                raise
+
+            return True
+
+        return False
+
+    def __create_in_first(self, users):
+        """
+        Create the token's access key in the first of `users` whose slot can
+        still be claimed. Returns False if none could be.
+        """
+        for user in users:
+            try:
+                access_key = iam.create_access_key(UserName=user.username)
+            except iam.exceptions.LimitExceededException:
+                continue
+
+            if self.__claim_slot(user, access_key['AccessKey']):
+                return True
+
+        return False
 
     def __delete(self):
-        self.table.delete_item(Key={'AccessKeyID': self.access_key_id})
+        dynamodb_client.transact_write_items(TransactItems=self.__get_release_transaction())
+        State.bump_version(self.version_state_id)
         self.exists = False
         self.access_key_id = None
         self.create_time = None
@@ -475,28 +949,105 @@ class HoneyToken:
         self.location = None
         self.description = None
 
-    def generate(self):
-        # Create
-        self.user = IAMUser.get_next_user()
-        access_key = iam.create_access_key(UserName=self.user.username)
+    def generate(self, settings=None):
+        """
+        Create the token, which settings may give an expire_time, active,
+        location and description. They are applied before the slot is
+        claimed, so the token is written once with its final attributes.
+        """
+        # Set attrs
+        self.__apply_settings(settings or {})
 
-        try:
-            self.user.increment_token_count()
-        except Exception as e:
-            iam.delete_access_key(UserName=self.user.username, AccessKeyId=access_key['AccessKey']['AccessKeyId'])
-            raise e
+        # Create in the first candidate user whose slot can still be claimed.
+        if not self.__create_in_first(IAMUser.iter_candidates()):
+            raise Exception("No IAM user with a free token slot.")
 
-        self.access_key_id = access_key['AccessKey']['AccessKeyId']
-        self.secret_access_key = access_key['AccessKey']['SecretAccessKey']
+        self.user.num_tokens += 1
+        State.bump_version(self.version_state_id)
 
-        # Set attrs
+    def __apply_settings(self, settings):
         self.create_time = int(time.time())
-        self.set_expire_time()
-        self.set_active()
-        self.set_location()
-        self.set_description()
+        self.set_expire_time(settings.get('expire_time'))
+        self.set_active(settings.get('active'))
+        self.set_location(settings.get('location'))
+        self.set_description(settings.get('description'))
 
-        self.__write()
+    @classmethod
+    def __from_settings(cls, settings):
+        token = HoneyToken()
+        token.__apply_settings(settings)
+        return token
+
+    @classmethod
+    def __generate_in_slots(cls, user, settings):
+        """
+        Create tokens for (index, settings) pairs in one user's slots, one
+        after another so their claims do not conflict on the user's item.
+        Returns (index, result) pairs, where result is the new HoneyToken,
+        None if the slot was lost, or the Exception that stopped it.
+        """
+        results = []
+
+        for i, token_settings in settings:
+            token = cls.__from_settings(token_settings)
+            try:
+                results.append((i, token if token.__create_in_first([user]) else None))
+            except Exception as e:
+                results.append((i, e))
+
+        return results
+
+    @classmethod
+    def generate_many(cls, settings):
+        """
+        Create one token per settings dict, which may set expire_time,
+        active, location and description. Free user slots are found up
+        front, then each user's tokens are made by a worker of their own, so
+        IAM calls and slot claims run concurrently across users. Tokens
+        whose slot was lost to another request, or for which no slot was
+        found, go to the next candidate user instead. Returns a list in the
+        same order holding the new HoneyToken, or the Exception that
+        stopped it.
+        """
+        slots = IAMUser.get_free_slots(len(settings))
+        results = [None] * len(settings)
+
+        by_user = {}
+        for i, user in enumerate(slots):
+            by_user.setdefault(user.username, (user, []))[1].append((i, settings[i]))
+
+        if by_user:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(IAM_CONCURRENCY, len(by_user))) as executor:
+                futures = [
+                    executor.submit(cls.__generate_in_slots, user, user_settings)
+                    for user, user_settings in by_user.values()
+                ]
+
+                for future in concurrent.futures.as_completed(futures):
+                    for i, result in future.result():
+                        results[i] = result
+
+        for i, result in enumerate(results):
+            if result is not None:
+                continue
+
+            token = cls.__from_settings(settings[i])
+            try:
+                if token.__create_in_first(IAMUser.iter_candidates()):
+                    results[i] = token
+                else:
+                    results[i] = Exception("No IAM user with a free token slot.")
+            except Exception as e:
+                results[i] = e
+
+        for token in results:
+            if isinstance(token, HoneyToken):
+                token.user.num_tokens += 1
+
+        if any(isinstance(token, HoneyToken) for token in results):
+            State.bump_version(cls.version_state_id)
+
+        return results
 
     def get_dict(self):
         return {
@@ -541,42 +1092,210 @@ class HoneyToken:
 
     def delete(self):
         if self.exists:
-            # Delete real IAM access key and decrement user token count in database.
-            iam.delete_access_key(UserName=self.user.username, AccessKeyId=self.access_key_id)
-            self.user.decrement_token_count()
-
-            # Scrub events table.
+            # Delete real IAM access key. It is already gone if an earlier
+            # attempt failed part way, and the rest still needs doing.
+            try:
+                iam.delete_access_key(UserName=self.username, AccessKeyId=self.access_key_id)
+            except iam.exceptions.NoSuchEntityException:
+                pass
+
+            # Scrub events table and archive.
             Event.delete_events_for_token(self.access_key_id)
+            if EventArchive.bucket:
+                EventArchive.delete_partitions(self.access_key_id)
+            EventStats.delete(self.access_key_id)
 
+            # Delete the token and free its user slot, then the user if it has
+            # no tokens left.
+            username = self.username
             self.__delete()
 
+            user = IAMUser(username)
+            if user.exists and user.num_tokens <= 0:
+                user.delete()
+
 
 class IAMUser:
     table = dynamodb.Table("{}-iam-users".format(os.environ['APP_NAME']))
     group_name = "{}-honey-users".format(os.environ['APP_NAME'])
+    # IAM allows two access keys per user.
+    max_tokens = 2
 
     @classmethod
-    def get_next_user(cls):
-        # Fetch or generate a user for use with a new token.
-        response = cls.table.query(
-            IndexName="NumTokens",
-            KeyConditions={
-                'NumTokens': {
-                    'AttributeValueList': [1],
-                    'ComparisonOperator': 'EQ'
-                }
-            },
-            Limit=1
-        )
+    def iter_candidates(cls):
+        """
+        Yield users that may have a free token slot: users already holding a
+        token, then unused users from the pool, then a newly created user.
+        The NumTokens index is eventually consistent and other requests may
+        be claiming the same slots, so a slot is only taken once it has been
+        claimed with a conditional write. Candidates are shuffled to spread
+        concurrent requests over different users.
+        """
+        for num_tokens in range(cls.max_tokens - 1, -1, -1):
+            response = cls.table.query(
+                IndexName="NumTokens",
+                KeyConditions={
+                    'NumTokens': {
+                        'AttributeValueList': [num_tokens],
+                        'ComparisonOperator': 'EQ'
+                    }
+                },
+                Limit=CANDIDATE_USERS
+            )
+            items = response['Items']
+            random.shuffle(items)
 
-        # If user exists, length will be 1.
-        for item in response['Items']:
-            return IAMUser(item['Username'])
+            for item in items:
+                user = IAMUser(item['Username'])
+                if user.exists and user.num_tokens < cls.max_tokens:
+                    yield user
 
         # No suitable user exists. Create new.
         new_user = IAMUser()
         new_user.generate()
-        return new_user
+        yield new_user
+
+    @classmethod
+    def count_users(cls, num_tokens):
+        """
+        Number of users holding exactly num_tokens tokens, from the
+        NumTokens index.
+        """
+        query_args = {
+            'IndexName': "NumTokens",
+            'Select': 'COUNT',
+            'KeyConditions': {
+                'NumTokens': {
+                    'AttributeValueList': [num_tokens],
+                    'ComparisonOperator': 'EQ'
+                }
+            }
+        }
+        count = 0
+
+        while True:
+            response = cls.table.query(**query_args)
+            count += response['Count']
+
+            if 'LastEvaluatedKey' not in response:
+                return count
+
+            query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    @classmethod
+    def get(cls, username):
+        """
+        The user from the invocation's identity map, read on first use.
+        """
+        return identity_map.get(cls, username)
+
+    @classmethod
+    def get_users(cls, usernames):
+        """
+        Look up many users at once. Returns a dict of username to IAMUser.
+        Users missing from the table are returned with exists=False, matching
+        IAMUser(username).
+        """
+        keys = [{'Username': username} for username in set(usernames)]
+        items = {item['Username']: item for item in batch_get_items(cls.table, keys, consistent_read=True)}
+
+        users = {}
+        for key in keys:
+            user = IAMUser()
+            user.username = key['Username']
+            if user.username in items:
+                user.__load(items[user.username])
+            users[user.username] = user
+
+        return users
+
+    @classmethod
+    def get_free_slots(cls, count):
+        """
+        Users to hold `count` new tokens, one entry per free token slot, so
+        a user with two free slots can appear twice. Users already holding a
+        token are used first, then unused users from the pool, then new
+        users are created for the rest. May come up short if creating users
+        fails.
+        """
+        usernames = []
+
+        for num_tokens in range(cls.max_tokens - 1, -1, -1):
+            query_args = {
+                'IndexName': "NumTokens",
+                'KeyConditions': {
+                    'NumTokens': {
+                        'AttributeValueList': [num_tokens],
+                        'ComparisonOperator': 'EQ'
+                    }
+                }
+            }
+
+            while len(usernames) < count:
+                response = cls.table.query(**query_args)
+                usernames.extend(item['Username'] for item in response.get('Items', []))
+
+                if 'LastEvaluatedKey' not in response:
+                    break
+
+                query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        slots = []
+        for user in cls.get_users(usernames[:count]).values():
+            if user.exists:
+                slots.extend([user] * (cls.max_tokens - int(user.num_tokens)))
+
+        new_users = cls.generate_many((count - len(slots) + cls.max_tokens - 1) // cls.max_tokens)
+        for user in new_users:
+            slots.extend([user] * cls.max_tokens)
+
+        return slots[:count]
+
+    @classmethod
+    def generate_many(cls, count):
+        """
+        Create `count` new IAM users, with the IAM calls made concurrently.
+        Returns the users that were created and saved.
+        """
+        if count <= 0:
+            return []
+
+        users = []
+
+        while len(users) < count:
+            usernames = [str(uuid.uuid4()) for _ in range(count - len(users))]
+            for user in cls.get_users(usernames).values():
+                # Skip names already taken. Very unlikely.
+                if not user.exists:
+                    user.create_time = int(time.time())
+                    user.account_id = get_account_id()
+                    user.num_tokens = 0
+                    users.append(user)
+
+        created = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=IAM_CONCURRENCY) as executor:
+            futures = {executor.submit(user.__create_iam_user): user for user in users}
+
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    logger.error("Failed to create IAM user '{}': {}".format(
+                        futures[future].username, future.exception()))
+                    continue
+
+                created.append(futures[future])
+
+        cls.save_users(created)
+        return created
+
+    @classmethod
+    def save_users(cls, users):
+        """
+        Write many users with a batch writer.
+        """
+        with cls.table.batch_writer(overwrite_by_pkeys=['Username']) as batch:
+            for user in users:
+                batch.put_item(Item=user.__get_item())
+                user.exists = True
 
     def __init__(self, username=None):
         self.exists = False
@@ -597,23 +1316,27 @@ class IAMUser:
         if 'Item' not in response:
             return
 
-        item = response['Item']
+        self.__load(response['Item'])
+
+    def __load(self, item):
         self.exists = True
         self.create_time = item.get('CreateTime', None)
         self.account_id = item.get('AccountID', None)
         self.num_tokens = item.get('NumTokens', None)
 
-    def __write(self):
-        self.table.put_item(Item={
+    def __get_item(self):
+        return {
             'Username': self.username,
             'CreateTime': self.create_time,
             'AccountID': self.account_id,
             'NumTokens': self.num_tokens
-        })
+        }
+
+    def __write(self):
+        self.table.put_item(Item=self.__get_item())
         self.exists = True
 
     def __delete(self):
-        self.table.delete_item(Key={'Username': self.username})
         self.exists = False
         self.username = None
         self.account_id = None
@@ -629,9 +1352,13 @@ class IAMUser:
             break
 
         self.create_time = int(time.time())
-        self.account_id = sts.get_caller_identity()['Account']
+        self.account_id = get_account_id()
         self.num_tokens = 0
 
+        self.__create_iam_user()
+        self.__write()
+
+    def __create_iam_user(self):
         iam.create_user(
             UserName=self.username,
             Tags=[
@@ -640,8 +1367,6 @@ class IAMUser:
         )
         iam.add_user_to_group(UserName=self.username, GroupName=self.group_name)
 
-        self.__write()
-
     def get_dict(self):
         return {
             'username': self.username,
@@ -650,36 +1375,998 @@ class IAMUser:
             'num_tokens': int(self.num_tokens)
         }
 
-    def increment_token_count(self):
-        if not self.exists:
-            raise Exception("User does not exist when incrementing token count.")
+    def delete(self):
+        if self.exists:
+            if self.num_tokens > 0:
+                raise Exception("Tried to delete user with honey tokens.")
 
-        if self.num_tokens >= 2:
-            raise Exception("Too many tokens for user '{}'".format(self.username))
+            # Remove the item first, so its slots can no longer be claimed.
+            try:
+                self.table.delete_item(
+                    Key={'Username': self.username},
+                    ConditionExpression="NumTokens <= :zero",
+                    ExpressionAttributeValues={':zero': 0}
+                )
+            except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+                # A token was created in the user meanwhile.
+                return
 
-        self.num_tokens += 1
-        self.__write()
+            iam.remove_user_from_group(UserName=self.username, GroupName=self.group_name)
+            try:
+                iam.delete_user(UserName=self.username)
+            except iam.exceptions.DeleteConflictException:
+                # A token creation made an access key in the user before the
+                # item was removed. Keep the user so its claim can succeed.
+                iam.add_user_to_group(UserName=self.username, GroupName=self.group_name)
+                self.__write()
+                return
 
-    def decrement_token_count(self):
-        if not self.exists:
-            raise Exception("User does not exist when decrementing token count.")
+            self.__delete()
+
+
+class State:
+    """
+    Small key/value items shared between functions, such as version markers.
+    """
+    table = dynamodb.Table("{}-state".format(os.environ['APP_NAME']))
 
-        self.num_tokens -= 1
+    @classmethod
+    def get_version(cls, state_id, consistent_read=False):
+        response = cls.table.get_item(Key={'StateID': state_id}, ConsistentRead=consistent_read)
+        return int(response.get('Item', {}).get('Version', 0))
+
+    @classmethod
+    def bump_version(cls, state_id):
+        cls.table.update_item(
+            Key={'StateID': state_id},
+            UpdateExpression="ADD Version :one",
+            ExpressionAttributeValues={':one': 1}
+        )
+
+
+class ProcessedObject:
+    """
+    Ledger of CloudTrail files handled by the CloudTrail function, kept in the
+    state table so redelivered notifications and retried invocations skip
+    files that are already done.
+
+    Items are keyed by bucket and object key, since CloudTrail never rewrites
+    a log file; the ETag seen is recorded with each completed file. A claim
+    marks a file as in progress until its lease runs out, which the claiming
+    invocation sets just past its own timeout, so a retry after the
+    invocation dies can take the file over.
+    """
+    table = State.table
+
+    @staticmethod
+    def get_state_id(bucket, object_key):
+        return "processed-object#{}/{}".format(bucket, object_key)
+
+    @classmethod
+    def get_processed(cls, cloudtrail_objects):
+        keys = [{'StateID': cls.get_state_id(bucket, object_key)} for bucket, object_key in set(cloudtrail_objects)]
+        items = batch_get_items(cls.table, keys, consistent_read=True)
+
+        return {
+            (item['Bucket'], item['ObjectKey'])
+            for item in items
+            if item.get('Status') == "done"
+        }
+
+    @classmethod
+    def claim(cls, bucket, object_key, ttl, lease):
+        """
+        Claim a file for `lease` seconds. Returns False if it is done or
+        another invocation holds a live claim on it.
+        """
+        now = int(time.time())
+
+        try:
+            cls.table.put_item(
+                Item={
+                    'StateID': cls.get_state_id(bucket, object_key),
+                    'Bucket': bucket,
+                    'ObjectKey': object_key,
+                    'Status': "pending",
+                    'ClaimTime': now,
+                    'LeaseTime': now + lease,
+                    'ExpireTime': now + ttl
+                },
+                ConditionExpression="attribute_not_exists(StateID) OR (#status = :pending AND LeaseTime < :now)",
+                ExpressionAttributeNames={'#status': 'Status'},
+                ExpressionAttributeValues={':pending': "pending", ':now': now}
+            )
+        except cls.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+        return True
+
+    @classmethod
+    def complete(cls, bucket, object_key, etag, ttl):
+        now = int(time.time())
+        cls.table.put_item(Item={
+            'StateID': cls.get_state_id(bucket, object_key),
+            'Bucket': bucket,
+            'ObjectKey': object_key,
+            'ETag': etag,
+            'Status': "done",
+            'CompleteTime': now,
+            'ExpireTime': now + ttl
+        })
+
+    @classmethod
+    def release(cls, bucket, object_key):
+        try:
+            cls.table.delete_item(
+                Key={'StateID': cls.get_state_id(bucket, object_key)},
+                ConditionExpression="#status = :pending",
+                ExpressionAttributeNames={'#status': 'Status'},
+                ExpressionAttributeValues={':pending': "pending"}
+            )
+        except cls.table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+
+class AlertState:
+    """
+    Per-token alert cooldown state, kept in the state table. Deciding whether
+    an event alerts is a single conditional write on one small item, so its
+    cost does not grow with the token's event history, and concurrent
+    invocations cannot both alert for the same cooldown window.
 
-        if self.num_tokens <= 0:
-            self.delete()
+    LastAlertTime is 0 for a token that has never alerted. Tokens without a
+    state item yet are seeded once from their alerted events.
+    """
+    table = State.table
+
+    @staticmethod
+    def get_state_id(access_key_id):
+        return "alert-state#{}".format(access_key_id)
+
+    @staticmethod
+    def is_clear(last_alert_time, event_time, cooldown):
+        if cooldown == 0:
+            return True
+        if cooldown < 0:
+            return last_alert_time == 0
+        return last_alert_time <= event_time - cooldown
+
+    @classmethod
+    def get_last_alert_time(cls, access_key_id):
+        response = cls.table.get_item(Key={'StateID': cls.get_state_id(access_key_id)}, ConsistentRead=True)
+
+        if 'Item' not in response:
+            return None
+
+        return int(response['Item']['LastAlertTime'])
+
+    @classmethod
+    def try_alert(cls, access_key_id, event_time, cooldown):
+        """
+        Claim an alert for an event if the token is out of cooldown. Returns
+        (alerted, last_alert_time, previous_alert_time), where
+        last_alert_time is the token's last alert time after the attempt and
+        previous_alert_time the one a claim replaced, for release(). It is
+        None when nothing was claimed.
+        """
+        if cooldown == 0:
+            return True, event_time, None
+
+        previous_alert_time = cls.__claim(access_key_id, event_time, cooldown)
+        if previous_alert_time is not None:
+            return True, event_time, previous_alert_time
+
+        last_alert_time = cls.get_last_alert_time(access_key_id)
+        if last_alert_time is not None:
+            return False, last_alert_time, None
+
+        cls.__seed(access_key_id, event_time, cooldown)
+        previous_alert_time = cls.__claim(access_key_id, event_time, cooldown)
+        if previous_alert_time is not None:
+            return True, event_time, previous_alert_time
+
+        return False, cls.get_last_alert_time(access_key_id), None
+
+    @classmethod
+    def release(cls, access_key_id, event_time, previous_alert_time):
+        """
+        Give back an alert claimed for event_time that could not be sent, so
+        the token is not left in cooldown for it. Does nothing if a later
+        alert has been claimed since.
+        """
+        try:
+            cls.table.update_item(
+                Key={'StateID': cls.get_state_id(access_key_id)},
+                UpdateExpression="SET LastAlertTime = :previous",
+                ConditionExpression="LastAlertTime = :event_time",
+                ExpressionAttributeValues={':previous': int(previous_alert_time), ':event_time': int(event_time)}
+            )
+        except cls.table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    @classmethod
+    def __claim(cls, access_key_id, event_time, cooldown):
+        """
+        Returns the LastAlertTime the claim replaced, or None if the token is
+        still in cooldown.
+        """
+        if cooldown < 0:
+            condition = "LastAlertTime = :zero"
+            values = {':zero': 0}
         else:
-            self.__write()
+            condition = "LastAlertTime <= :threshold"
+            values = {':threshold': int(event_time - cooldown)}
 
-    def delete(self):
-        if self.exists:
-            if self.num_tokens > 0:
-                raise Exception("Tried to delete user with honey tokens.")
+        try:
+            response = cls.table.update_item(
+                Key={'StateID': cls.get_state_id(access_key_id)},
+                UpdateExpression="SET LastAlertTime = :event_time",
+                ConditionExpression=condition,
+                ExpressionAttributeValues={':event_time': int(event_time), **values},
+                ReturnValues="UPDATED_OLD"
+            )
+        except cls.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return None
 
-            iam.remove_user_from_group(UserName=self.username, GroupName=self.group_name)
-            iam.delete_user(UserName=self.username)
+        return int(response['Attributes']['LastAlertTime'])
 
-            self.__delete()
+    @classmethod
+    def __seed(cls, access_key_id, event_time, cooldown):
+        last_alert_time = Event.get_last_alert_time(access_key_id, event_time, cooldown)
+
+        try:
+            cls.table.put_item(
+                Item={
+                    'StateID': cls.get_state_id(access_key_id),
+                    'LastAlertTime': last_alert_time or 0
+                },
+                ConditionExpression="attribute_not_exists(StateID)"
+            )
+        except cls.table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+
+class EventCounter:
+    """
+    Base for state items that count a token's events by attribute. Counts
+    live in one nested map per dimension and are updated with atomic ADDs, a
+    chunk of counters per write to stay within DynamoDB's expression limits.
+    An item that hits the item size limit stops breaking down new values but
+    keeps counting events, and is marked Truncated.
+    """
+    table = State.table
+    state_prefix = None
+    dimensions = ('EventName', 'EventRegion', 'SourceIPAddress', 'UserAgent')
+    # Keeps update expressions well under DynamoDB's 4 KB limit.
+    counters_per_update = 25
+    max_value_length = 256
+    # Outlives the 24 hours a retried stream batch can be redelivered for.
+    applied_ttl = 2 * 24 * 3600
+
+    @classmethod
+    def get_state_id(cls, access_key_id):
+        return "{}#{}".format(cls.state_prefix, access_key_id)
+
+    @classmethod
+    def get_values(cls, event):
+        """
+        Dimension values of an event dict, as returned by Event.get_dict().
+        """
+        return {
+            'EventName': event['event_name'],
+            'EventRegion': event['event_region'],
+            'SourceIPAddress': event['source_ip_address'],
+            'UserAgent': event['user_agent']
+        }
+
+    @classmethod
+    def summarize(cls, events):
+        """
+        Count a batch of event dicts by each dimension.
+        """
+        counts = {dimension: {} for dimension in cls.dimensions}
+
+        for event in events:
+            for dimension, value in cls.get_values(event).items():
+                value = str(value or "-")[:cls.max_value_length]
+                counts[dimension][value] = counts[dimension].get(value, 0) + 1
+
+        event_times = [int(event['event_time']) for event in events]
+        return {
+            'EventCount': len(events),
+            'FirstSeen': min(event_times),
+            'LastSeen': max(event_times),
+            'Counts': counts,
+            'Truncated': False
+        }
+
+    @staticmethod
+    def get_summary(item):
+        return {
+            'EventCount': int(item['EventCount']),
+            'FirstSeen': int(item['FirstSeen']),
+            'LastSeen': int(item['LastSeen']),
+            'Counts': {
+                dimension: {value: int(count) for value, count in counts.items()}
+                for dimension, counts in item['Counts'].items()
+            },
+            'Truncated': bool(item.get('Truncated'))
+        }
+
+    @classmethod
+    def get_item(cls, access_key_id):
+        return cls.table.get_item(Key={'StateID': cls.get_state_id(access_key_id)}).get('Item')
+
+    @classmethod
+    def get_applied_id(cls, access_key_id, batch_id, offset):
+        """
+        State ID recording that the write of a batch's counters from offset
+        on was applied, or None without a batch.
+        """
+        if batch_id is None:
+            return None
+        return "{}-applied#{}#{}#{}".format(cls.state_prefix, access_key_id, batch_id, offset)
+
+    @classmethod
+    def add_summary(cls, access_key_id, summary, attributes=None, batch_id=None):
+        """
+        Fold a summary into the token's item, creating it with the given
+        extra attributes if it does not exist. Whatever is left when the
+        item is removed part way goes into a new one.
+
+        With a batch_id, each write is made in a transaction that also
+        records it as applied, and writes already recorded are skipped, so
+        folding the same summary again under the same batch_id does not
+        count anything twice.
+        """
+        counters = [
+            (dimension, value, count)
+            for dimension, counts in summary['Counts'].items()
+            for value, count in counts.items()
+        ]
+        event_count = summary['EventCount']
+        truncated = summary['Truncated']
+        merged = False
+        offset = 0
+
+        for attempt in range(BATCH_RETRY_LIMIT):
+            chunk = counters[:cls.counters_per_update]
+            if cls.__open(access_key_id, summary, attributes or {}, event_count, chunk, truncated,
+                          cls.get_applied_id(access_key_id, batch_id, offset)):
+                counters = counters[len(chunk):]
+                offset += len(chunk)
+                event_count, truncated = 0, False
+
+            while counters or event_count or truncated:
+                chunk = counters[:cls.counters_per_update]
+                if not cls.__merge(access_key_id, event_count, chunk, truncated,
+                                   cls.get_applied_id(access_key_id, batch_id, offset)):
+                    break
+                counters = counters[len(chunk):]
+                offset += len(chunk)
+                event_count, truncated = 0, False
+                merged = True
+            else:
+                break
+        else:
+            raise Exception("Could not update {}.".format(cls.get_state_id(access_key_id)))
+
+        if merged:
+            cls.__widen(access_key_id, 'FirstSeen', '>', summary['FirstSeen'])
+            cls.__widen(access_key_id, 'LastSeen', '<', summary['LastSeen'])
+
+    @classmethod
+    def delete(cls, access_key_id):
+        cls.table.delete_item(Key={'StateID': cls.get_state_id(access_key_id)})
+
+    @classmethod
+    def __write(cls, action, args, applied_id):
+        """
+        Make a PutItem ('Put') or UpdateItem ('Update') request. With an
+        applied_id, the write goes in a transaction with a conditional put
+        of that ID, and is skipped if the ID shows an earlier attempt made
+        it. A cancelled transaction raises the error the write alone would
+        have, and one cancelled by a concurrent transaction is retried with
+        exponential backoff.
+        """
+        if applied_id is None:
+            if action == 'Put':
+                cls.table.put_item(**args)
+            else:
+                cls.table.update_item(**args)
+            return
+
+        serializer = boto3.dynamodb.types.TypeSerializer()
+        request = {**args, 'TableName': cls.table.name}
+        for name in ('Item', 'Key', 'ExpressionAttributeValues'):
+            if name in request:
+                request[name] = {key: serializer.serialize(value) for key, value in request[name].items()}
+
+        applied = {
+            'StateID': applied_id,
+            'ExpireTime': int(time.time()) + cls.applied_ttl
+        }
+        client = dynamodb_client
+
+        for attempt in range(BATCH_RETRY_LIMIT):
+            if attempt:
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+
+            try:
+                client.transact_write_items(TransactItems=[
+                    {action: request},
+                    {'Put': {
+                        'TableName': cls.table.name,
+                        'Item': {name: serializer.serialize(value) for name, value in applied.items()},
+                        'ConditionExpression': "attribute_not_exists(StateID)"
+                    }}
+                ])
+            except client.exceptions.TransactionCanceledException as e:
+                reasons = e.response.get('CancellationReasons', [])
+                codes = [reason.get('Code') for reason in reasons]
+
+                if codes[1:2] == ['ConditionalCheckFailed']:
+                    return
+                if 'TransactionConflict' in codes:
+                    continue
+
+                error = {'Error': {'Code': codes[0], 'Message': reasons[0].get('Message')}}
+                if codes[0] == 'ConditionalCheckFailed':
+                    error['Error']['Code'] = 'ConditionalCheckFailedException'
+                    raise client.exceptions.ConditionalCheckFailedException(error, 'TransactWriteItems')
+                if codes[0] == 'ValidationError':
+                    error['Error']['Code'] = 'ValidationException'
+                raise client.exceptions.ClientError(error, 'TransactWriteItems')
+
+            return
+
+        raise Exception("Could not write {} after {} attempts.".format(applied_id, BATCH_RETRY_LIMIT))
+
+    @classmethod
+    def __open(cls, access_key_id, summary, attributes, event_count, counters, truncated, applied_id):
+        counts = {dimension: {} for dimension in cls.dimensions}
+        for dimension, value, count in counters:
+            counts[dimension][value] = count
+
+        item = {
+            **attributes,
+            'StateID': cls.get_state_id(access_key_id),
+            'AccessKeyID': access_key_id,
+            'EventCount': event_count,
+            'FirstSeen': summary['FirstSeen'],
+            'LastSeen': summary['LastSeen'],
+            'Counts': counts,
+            'Truncated': truncated,
+            'Revision': 1
+        }
+
+        try:
+            cls.__write('Put', {'Item': item, 'ConditionExpression': "attribute_not_exists(StateID)"}, applied_id)
+        except cls.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+        return True
+
+    @classmethod
+    def __merge(cls, access_key_id, event_count, counters, truncated, applied_id):
+        names = {}
+        values = {':one': 1}
+        updates = []
+
+        for i, (dimension, value, count) in enumerate(counters):
+            names.update({'#counts': 'Counts', '#' + dimension: dimension, '#v{}'.format(i): value})
+            path = "#counts.#{}.#v{}".format(dimension, i)
+            updates.append("{0} = if_not_exists({0}, :zero) + :c{1}".format(path, i))
+            values.update({':zero': 0, ':c{}'.format(i): count})
+
+        if truncated:
+            updates.append("Truncated = :truncated")
+            values[':truncated'] = True
+
+        additions = ["Revision :one"]
+        if event_count:
+            additions.append("EventCount :event_count")
+            values[':event_count'] = event_count
+
+        expression = "ADD " + ", ".join(additions)
+        if updates:
+            expression = "SET " + ", ".join(updates) + " " + expression
+
+        update_args = {
+            'Key': {'StateID': cls.get_state_id(access_key_id)},
+            'UpdateExpression': expression,
+            'ConditionExpression': "attribute_exists(StateID)",
+            'ExpressionAttributeValues': values
+        }
+        if names:
+            update_args['ExpressionAttributeNames'] = names
+
+        try:
+            cls.__write('Update', update_args, applied_id)
+        except cls.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        except cls.table.meta.client.exceptions.ClientError as e:
+            # The item size limit: keep counting events, drop the new values.
+            if not counters or e.response['Error']['Code'] != 'ValidationException':
+                raise
+            logger.warning("{} is full, dropping {} counters.".format(cls.get_state_id(access_key_id), len(counters)))
+            return cls.__merge(access_key_id, event_count, [], True, applied_id)
+
+        return True
+
+    @classmethod
+    def __widen(cls, access_key_id, attribute, comparison, event_time):
+        """
+        Move FirstSeen back or LastSeen forward to event_time if it is
+        outside them.
+        """
+        try:
+            cls.table.update_item(
+                Key={'StateID': cls.get_state_id(access_key_id)},
+                UpdateExpression="SET {0} = :event_time".format(attribute),
+                ConditionExpression="attribute_exists(StateID) AND {} {} :event_time".format(attribute, comparison),
+                ExpressionAttributeValues={':event_time': int(event_time)}
+            )
+        except cls.table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+
+class AlertDigest(EventCounter):
+    """
+    Per-token digest of honey events for digest mode alerts. Each recorded
+    batch of a token's events is folded into its digest. The first batch
+    opens the digest with a flush time one window later, and the digest
+    task publishes each due digest as a single alert and clears it.
+
+    Every write bumps Revision, so a digest is only cleared if nothing was
+    folded into it after it was read.
+    """
+    state_prefix = "alert-digest"
+    index_name = "FlushTime"
+    # Values sent per dimension in a digest alert, most frequent first. A
+    # digest item can grow far past SNS's 256 KB message limit.
+    alert_values = 20
+
+    @classmethod
+    def get_dict(cls, item):
+        """
+        The digest as sent in an alert. Only the most frequent values of each
+        dimension are included; omitted_values counts the rest.
+        """
+        digest = {
+            'access_key_id': item['AccessKeyID'],
+            'event_count': int(item['EventCount']),
+            'first_seen': int(item['FirstSeen']),
+            'last_seen': int(item['LastSeen']),
+            'truncated': bool(item.get('Truncated')),
+            'omitted_values': {}
+        }
+
+        for name, dimension in (
+                ('event_names', 'EventName'),
+                ('event_regions', 'EventRegion'),
+                ('source_ip_addresses', 'SourceIPAddress'),
+                ('user_agents', 'UserAgent')):
+            ranked = sorted(item['Counts'][dimension].items(), key=lambda count: (-count[1], count[0]))
+            digest[name] = dict(ranked[:cls.alert_values])
+            digest['omitted_values'][name] = max(len(ranked) - cls.alert_values, 0)
+
+        return digest
+
+    @classmethod
+    def add(cls, access_key_id, token, summary, flush_time):
+        """
+        Fold a summary into the token's digest, opening a digest that flushes
+        at flush_time if none is open.
+        """
+        cls.add_summary(access_key_id, summary, {'Token': token, 'FlushTime': int(flush_time)})
+
+    @classmethod
+    def get_due_access_key_ids(cls, current_time):
+        """
+        Access key IDs of digests whose flush time has passed, from the
+        sparse FlushTime index.
+        """
+        scan_args = {
+            'IndexName': cls.index_name,
+            'ScanFilter': {
+                'FlushTime': {
+                    'AttributeValueList': [int(current_time)],
+                    'ComparisonOperator': 'LE'
+                }
+            }
+        }
+        access_key_ids = []
+
+        while True:
+            response = cls.table.scan(**scan_args)
+            access_key_ids.extend(item['AccessKeyID'] for item in response['Items'])
+
+            if 'LastEvaluatedKey' not in response:
+                return access_key_ids
+
+            scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    @classmethod
+    def pop(cls, access_key_id):
+        """
+        Read and clear a token's digest. Returns the digest item, or None if
+        the token has no open digest.
+        """
+        key = {'StateID': cls.get_state_id(access_key_id)}
+
+        for attempt in range(BATCH_RETRY_LIMIT):
+            item = cls.table.get_item(Key=key, ConsistentRead=True).get('Item')
+            if item is None:
+                return None
+
+            try:
+                cls.table.delete_item(
+                    Key=key,
+                    ConditionExpression="Revision = :revision",
+                    ExpressionAttributeValues={':revision': item['Revision']}
+                )
+            except cls.table.meta.client.exceptions.ConditionalCheckFailedException:
+                continue
+
+            return item
+
+        raise Exception("Could not clear the alert digest for {}.".format(access_key_id))
+
+    @classmethod
+    def restore(cls, item, flush_time):
+        """
+        Fold a popped digest back in, e.g. after its alert failed to publish.
+        """
+        cls.add(item['AccessKeyID'], item['Token'], cls.get_summary(item), flush_time)
+
+
+class EventStats(EventCounter):
+    """
+    Lifetime event rollups per token, maintained from the events table
+    stream, so stats are one read regardless of event history. Counts are
+    also kept per UTC day.
+    """
+    state_prefix = "event-stats"
+    dimensions = EventCounter.dimensions + ('Day',)
+
+    @classmethod
+    def get_values(cls, event):
+        values = super().get_values(event)
+        values['Day'] = datetime.datetime.utcfromtimestamp(int(event['event_time'])).strftime('%Y-%m-%d')
+        return values
+
+    @staticmethod
+    def get_dict(item):
+        return {
+            'access_key_id': item['AccessKeyID'],
+            'event_count': int(item['EventCount']),
+            'first_seen': int(item['FirstSeen']),
+            'last_seen': int(item['LastSeen']),
+            'days': item['Counts']['Day'],
+            'event_names': item['Counts']['EventName'],
+            'event_regions': item['Counts']['EventRegion'],
+            'source_ip_addresses': item['Counts']['SourceIPAddress'],
+            'user_agents': item['Counts']['UserAgent'],
+            'truncated': bool(item.get('Truncated'))
+        }
+
+
+class EventArchive:
+    """
+    Events older than the hot retention window, archived to S3 as gzipped
+    NDJSON with one object per token and UTC day:
+
+        <app_name>/event-archive/access_key_id=<id>/date=<YYYY-MM-DD>/events.ndjson.gz
+
+    ArchivedThrough in the state table is the end of the archived time
+    range. Events before it are read from S3 and events from it on from the
+    events table, where they expire by TTL some time after being archived.
+    """
+    bucket = os.environ.get('EVENT_ARCHIVE_BUCKET')
+    prefix = "{}/event-archive".format(os.environ['APP_NAME'])
+    state_id = "event-archive"
+    day = 86400
+
+    @staticmethod
+    def get_date(timestamp):
+        return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+    @classmethod
+    def get_archived_through(cls):
+        if not cls.bucket:
+            return 0
+
+        response = State.table.get_item(Key={'StateID': cls.state_id}, ConsistentRead=True)
+        return int(response.get('Item', {}).get('ArchivedThrough', 0))
+
+    @classmethod
+    def set_archived_through(cls, archived_through):
+        State.table.update_item(
+            Key={'StateID': cls.state_id},
+            UpdateExpression="SET ArchivedThrough = :archived_through",
+            ExpressionAttributeValues={':archived_through': int(archived_through)}
+        )
+
+    @classmethod
+    def get_partition_prefix(cls, access_key_id):
+        return "{}/access_key_id={}/".format(cls.prefix, access_key_id)
+
+    @classmethod
+    def get_object_key(cls, access_key_id, date):
+        return "{}date={}/events.ndjson.gz".format(cls.get_partition_prefix(access_key_id), date)
+
+    @classmethod
+    def get_partition_dates(cls, access_key_id, first_date, last_date):
+        """
+        Dates of a token's archived partitions between first_date and
+        last_date (inclusive), in order.
+        """
+        prefix = cls.get_partition_prefix(access_key_id)
+        paginator = s3.get_paginator('list_objects_v2')
+        dates = []
+
+        for page in paginator.paginate(Bucket=cls.bucket, Prefix=prefix, StartAfter=prefix + "date=" + first_date):
+            for item in page.get('Contents', []):
+                date = item['Key'][len(prefix) + len("date="):][:10]
+                if date > last_date:
+                    return dates
+                dates.append(date)
+
+        return dates
+
+    @classmethod
+    def read_partition(cls, access_key_id, date):
+        try:
+            body = s3.get_object(Bucket=cls.bucket, Key=cls.get_object_key(access_key_id, date))['Body'].read()
+        except s3.exceptions.NoSuchKey:
+            return []
+
+        return [json.loads(line) for line in gzip.decompress(body).decode('utf-8').splitlines() if line]
+
+    @classmethod
+    def write_partition(cls, access_key_id, date, events):
+        body = "".join(json.dumps(event, cls=DecimalEncoder) + "\n" for event in events)
+        s3.put_object(
+            Bucket=cls.bucket,
+            Key=cls.get_object_key(access_key_id, date),
+            Body=gzip.compress(body.encode('utf-8')),
+            ContentType="application/x-ndjson"
+        )
+
+    @classmethod
+    def archive_partition(cls, access_key_id, day_start):
+        """
+        Copy one token's events for one UTC day to S3, replacing any earlier
+        copy. Events written before retention was enabled have no TTL, so
+        they are deleted from the events table once archived. Returns the
+        number of events archived.
+        """
+        items = list(Event.iter_items_for_token(access_key_id, day_start, day_start + cls.day - 1))
+        if not items:
+            return 0
+
+        cls.write_partition(access_key_id, cls.get_date(day_start), [Event.get_item_dict(item) for item in items])
+
+        keys = [{'EventID': item['EventID']} for item in items if 'ExpireTime' not in item]
+        for i in range(0, len(keys), BATCH_WRITE_SIZE):
+            batch_delete_items(Event.table, keys[i:i + BATCH_WRITE_SIZE])
+
+        return len(items)
+
+    @classmethod
+    def delete_partitions(cls, access_key_id):
+        paginator = s3.get_paginator('list_objects_v2')
+
+        for page in paginator.paginate(Bucket=cls.bucket, Prefix=cls.get_partition_prefix(access_key_id)):
+            objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if objects:
+                s3.delete_objects(Bucket=cls.bucket, Delete={'Objects': objects, 'Quiet': True})
+
+    @classmethod
+    def get_events(cls, access_key_id, archived_through, limit, start_time=None, end_time=None,
+                   ascending=True, date=None, offset=0):
+        """
+        One page of a token's archived events before archived_through,
+        optionally bounded by event time (inclusive). A page continues from
+        `offset` events into the partition for `date`. Returns the events and
+        the (date, offset) to continue from, or None after the last one.
+        """
+        last_time = archived_through - 1 if end_time is None else min(end_time, archived_through - 1)
+        dates = cls.get_partition_dates(access_key_id, cls.get_date(start_time or 0), cls.get_date(last_time))
+        if not ascending:
+            dates.reverse()
+        if date is not None:
+            dates = [d for d in dates if (d >= date if ascending else d <= date)]
+
+        events = []
+        for partition_date in dates:
+            partition = [
+                event for event in cls.read_partition(access_key_id, partition_date)
+                if (start_time is None or event['event_time'] >= start_time) and event['event_time'] <= last_time
+            ]
+            partition.sort(key=lambda event: (event['event_time'], event['event_id']), reverse=not ascending)
+
+            start = offset if partition_date == date else 0
+            page = partition[start:start + limit - len(events)]
+            events.extend(page)
+
+            if len(events) >= limit:
+                return events, (partition_date, start + len(page))
+
+        return events, None
+
+
+class HoneyKeyFilter:
+    """
+    Compact membership set of active honey token access key IDs. Keys are
+    sorted and packed into fixed-width records so lookups are a binary search
+    over a single bytes object.
+
+    The token API publishes a new filter to S3 whenever tokens change. Each
+    filter records the honey token version it was built at, so readers can
+    tell when it is stale.
+    """
+    s3_key = "{}/honey-key-filter.bin".format(os.environ['APP_NAME'])
+    header = struct.Struct('>4sQII')
+    magic = b'SSKF'
+
+    def __init__(self, access_key_ids=(), version=0):
+        keys = sorted({access_key_id.encode('utf-8') for access_key_id in access_key_ids})
+        self.version = version
+        self.width = max((len(key) for key in keys), default=0)
+        self.count = len(keys)
+        self.data = b''.join(key.ljust(self.width) for key in keys)
+
+    def __contains__(self, access_key_id):
+        key = access_key_id.encode('utf-8')
+        if len(key) > self.width:
+            return False
+
+        key = key.ljust(self.width)
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            record = self.data[mid * self.width:(mid + 1) * self.width]
+            if record < key:
+                low = mid + 1
+            elif record > key:
+                high = mid
+            else:
+                return True
+
+        return False
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.data[i * self.width:(i + 1) * self.width].rstrip().decode('utf-8')
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def build(cls):
+        # Read the version before scanning so concurrent token changes can
+        # only make the filter look older than it is, never newer.
+        version = State.get_version(HoneyToken.version_state_id, consistent_read=True)
+        return cls(HoneyToken.get_active_access_key_ids(), version)
+
+    @classmethod
+    def loads(cls, raw):
+        magic, version, width, count = cls.header.unpack_from(raw)
+        if magic != cls.magic:
+            raise ValueError("Not a honey key filter.")
+
+        key_filter = cls(version=version)
+        key_filter.width = width
+        key_filter.count = count
+        key_filter.data = raw[cls.header.size:cls.header.size + width * count]
+        return key_filter
+
+    def dumps(self):
+        return self.header.pack(self.magic, self.version, self.width, self.count) + self.data
+
+    @classmethod
+    def load(cls, bucket):
+        try:
+            response = s3.get_object(Bucket=bucket, Key=cls.s3_key)
+        except s3.exceptions.ClientError as e:
+            # A missing object surfaces as AccessDenied without s3:ListBucket.
+            logger.warning("Could not load honey key filter: {}".format(e))
+            return None
+
+        return cls.loads(response['Body'].read())
+
+    def publish(self, bucket):
+        s3.put_object(Bucket=bucket, Key=self.s3_key, Body=self.dumps())
+
+
+class HoneyTokenRegistry:
+    """
+    In-memory cache of active honey tokens. Meant to be kept at module scope
+    so warm Lambda containers can reuse it between invocations.
+
+    sync() resets the cache when the honey token version marker has changed,
+    or once max_age seconds have passed regardless. When a key filter bucket
+    is given, the published HoneyKeyFilter is loaded and only keys in it are
+    looked up in DynamoDB. Without one, or if the published filter is stale,
+    all active tokens are loaded with a table scan. A max_age of 0 disables
+    the registry and lookups go straight to DynamoDB.
+    """
+    def __init__(self, max_age=300, key_filter_bucket=None):
+        self.max_age = max_age
+        self.key_filter_bucket = key_filter_bucket
+        self.key_filter = None
+        self.version = None
+        self.load_time = 0
+        self.tokens = {}
+        self.looked_up = set()
+        self.access_key_ids = None
+
+    def sync(self):
+        if self.max_age <= 0:
+            return
+
+        now = int(time.time())
+        version = State.get_version(HoneyToken.version_state_id)
+
+        if version == self.version and now - self.load_time < self.max_age:
+            return
+
+        self.version = version
+        self.load_time = now
+        self.tokens = {}
+        self.looked_up = set()
+        self.key_filter = None
+        self.access_key_ids = None
+
+        if self.key_filter_bucket:
+            key_filter = HoneyKeyFilter.load(self.key_filter_bucket)
+
+            if key_filter is not None and key_filter.version >= version:
+                logger.info("Loaded honey key filter with {} keys at version {}.".format(
+                    len(key_filter), key_filter.version))
+                self.key_filter = key_filter
+                return
+
+            logger.info("Honey key filter missing or stale, loading all tokens instead.")
+
+        logger.info("Loading honey token registry at version {}.".format(version))
+        self.tokens = HoneyToken.get_active_tokens()
+
+    def get_access_key_ids(self):
+        """
+        All active honey token access key IDs as a frozenset of bytes, for
+        scanning raw log data. None when the registry is disabled.
+        """
+        if self.max_age <= 0:
+            return None
+
+        if self.access_key_ids is None:
+            keys = self.key_filter if self.key_filter is not None else self.tokens
+            self.access_key_ids = frozenset(access_key_id.encode('utf-8') for access_key_id in keys)
+
+        return self.access_key_ids
+
+    def get_tokens(self, access_key_ids):
+        if self.max_age <= 0:
+            return HoneyToken.get_tokens(access_key_ids)
+
+        if self.key_filter is not None:
+            candidates = [access_key_id for access_key_id in access_key_ids if access_key_id in self.key_filter]
+            missing = [access_key_id for access_key_id in candidates if access_key_id not in self.looked_up]
+
+            if missing:
+                self.tokens.update(HoneyToken.get_tokens(missing))
+                self.looked_up.update(missing)
+
+            access_key_ids = candidates
+
+        return {
+            access_key_id: self.tokens[access_key_id]
+            for access_key_id in access_key_ids
+            if access_key_id in self.tokens
+        }
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""
+Exports the whole events table as gzipped NDJSON parts, to a local directory
+or an S3 prefix, for incident response and SIEM ingestion.
+
+This is a command line tool, not a Lambda function. The table is read with a
+parallel segmented Scan, one worker thread per segment, and each item is
+written as soon as it is read, so memory use does not grow with table size.
+"""
+
+import app_common
+import argparse
+import base64
+import boto3
+import concurrent.futures
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+s3 = boto3.client('s3')
+
+
+def load_value(value):
+    """
+    Convert a DynamoDB JSON value to plain JSON types. Numbers become int or
+    float directly instead of going through Decimal.
+    """
+    (kind, data), = value.items()
+
+    if kind in ('S', 'BOOL'):
+        return data
+    if kind == 'N':
+        return load_number(data)
+    if kind == 'NULL':
+        return None
+    if kind == 'M':
+        return {name: load_value(item) for name, item in data.items()}
+    if kind == 'L':
+        return [load_value(item) for item in data]
+    if kind == 'SS':
+        return list(data)
+    if kind == 'NS':
+        return [load_number(item) for item in data]
+    if kind == 'B':
+        return base64.b64encode(data).decode('ascii')
+    if kind == 'BS':
+        return [base64.b64encode(item).decode('ascii') for item in data]
+
+    raise Exception("Unknown DynamoDB type '{}'.".format(kind))
+
+
+def load_number(data):
+    try:
+        return int(data)
+    except ValueError:
+        return float(data)
+
+
+class PartWriter:
+    """
+    Writes NDJSON lines to gzipped parts of at most part_records lines each,
+    named <name>-<part>.ndjson.gz under a local directory or s3://bucket/prefix.
+    An S3 part is buffered compressed in memory until it is complete.
+    """
+
+    def __init__(self, destination, name, part_records):
+        self.destination = destination
+        self.name = name
+        self.part_records = part_records
+        self.parts = 0
+        self.records = 0
+        self.buffer = None
+        self.file = None
+
+    def get_part_name(self):
+        return "{}-{:05d}.ndjson.gz".format(self.name, self.parts)
+
+    def __open(self):
+        if self.destination.startswith('s3://'):
+            self.buffer = io.BytesIO()
+            self.file = gzip.GzipFile(fileobj=self.buffer, mode='wb')
+        else:
+            self.file = gzip.open(os.path.join(self.destination, self.get_part_name()), 'wb')
+
+        self.records = 0
+
+    def __finish(self):
+        self.file.close()
+
+        if self.buffer is not None:
+            bucket, _, prefix = self.destination[len('s3://'):].partition('/')
+            s3.put_object(
+                Bucket=bucket,
+                Key="/".join(part for part in (prefix.rstrip('/'), self.get_part_name()) if part),
+                Body=self.buffer.getvalue(),
+                ContentType="application/x-ndjson"
+            )
+            self.buffer = None
+
+        self.file = None
+        self.parts += 1
+
+    def write(self, line):
+        if self.file is None:
+            self.__open()
+
+        self.file.write(line.encode('utf-8') + b'\n')
+        self.records += 1
+
+        if self.records >= self.part_records:
+            self.__finish()
+
+    def close(self):
+        if self.file is not None:
+            self.__finish()
+
+
+def export_segment(table_name, segment, total_segments, destination, part_records):
+    """
+    Scan one segment of the events table and write its events as parts
+    named events-<segment>-<part>.ndjson.gz.
+    """
+    writer = PartWriter(destination, "events-{:04d}".format(segment), part_records)
+    scan_args = {
+        'TableName': table_name,
+        'Segment': segment,
+        'TotalSegments': total_segments
+    }
+    num_events = 0
+
+    try:
+        while True:
+            response = app_common.dynamodb_client.scan(**scan_args)
+
+            for item in response.get('Items', []):
+                item = {name: load_value(value) for name, value in item.items()}
+                writer.write(json.dumps(app_common.Event.get_item_dict(item), separators=(',', ':')))
+                num_events += 1
+
+            if 'LastEvaluatedKey' not in response:
+                break
+
+            scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    finally:
+        writer.close()
+
+    return {'events': num_events, 'parts': writer.parts}
+
+
+def export(destination, segments, part_records):
+    """
+    Export all events to the destination with a scan of `segments`
+    segments in parallel. Returns event, part and failed segment counts.
+    """
+    if not destination.startswith('s3://'):
+        os.makedirs(destination, exist_ok=True)
+
+    table_name = app_common.Event.table.name
+    stats = {'events': 0, 'parts': 0, 'failed_segments': 0}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = {
+            executor.submit(export_segment, table_name, segment, segments, destination, part_records): segment
+            for segment in range(segments)
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception:
+                logger.exception("Failed to export segment {}".format(futures[future]))
+                stats['failed_segments'] += 1
+                continue
+
+            stats['events'] += result['events']
+            stats['parts'] += result['parts']
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export all honey events as gzipped NDJSON parts.")
+    parser.add_argument('destination', help="Local directory or s3://bucket/prefix to write parts to.")
+    parser.add_argument('--segments', type=int, default=8, help="Parallel scan segments, one thread each.")
+    parser.add_argument('--part-records', type=int, default=100000, help="Maximum events per part.")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, format="%(asctime)s %(levelname)s %(message)s")
+
+    stats = export(args.destination, args.segments, args.part_records)
+
+    logger.info(json.dumps(stats))
+    return 1 if stats['failed_segments'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+"""
+Replays honey token detection over archived CloudTrail files, from a local
+directory or an S3 prefix, and writes the matched honey events as NDJSON.
+
+This is a command line tool, not a Lambda function. It reuses the parse and
+match stages of the CloudTrail function, with all active honey tokens loaded
+once up front, so no DynamoDB calls are made per record.
+"""
+
+import app_common
+import task_cloudtrail_event
+import argparse
+import boto3
+import concurrent.futures
+import datetime
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+s3 = boto3.client('s3')
+
+# CloudTrail file names carry their delivery time, e.g.
+# 111122223333_CloudTrail_us-east-1_20210101T0005Z_abc123.json.gz
+FILE_TIME_PATTERN = re.compile(r'_(\d{8}T\d{4})Z_')
+
+key_pattern = None
+
+
+def list_cloudtrail_files(source):
+    """
+    Yield CloudTrail file paths under a local directory or an s3://bucket/prefix
+    location, in name order.
+    """
+    if source.startswith('s3://'):
+        bucket, _, prefix = source[len('s3://'):].partition('/')
+        paginator = s3.get_paginator('list_objects_v2')
+
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                if item['Key'].endswith('.json.gz'):
+                    yield "s3://{}/{}".format(bucket, item['Key'])
+        return
+
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.json.gz'):
+                yield os.path.join(root, name)
+
+
+def get_file_time(path):
+    match = FILE_TIME_PATTERN.search(path.rsplit('/', 1)[-1])
+    if not match:
+        return None
+
+    return datetime.datetime.strptime(match.group(1), '%Y%m%dT%H%M')
+
+
+def in_date_range(path, start=None, end=None):
+    """
+    Check a file's delivery time against [start, end). Files without a
+    recognizable time in their name are always included.
+    """
+    file_time = get_file_time(path)
+    if file_time is None:
+        return True
+
+    return (start is None or file_time >= start) and (end is None or file_time < end)
+
+
+def load_checkpoint(checkpoint):
+    if not checkpoint or not os.path.exists(checkpoint):
+        return set()
+
+    with open(checkpoint) as f:
+        return {line.rstrip('\n') for line in f if line.strip()}
+
+
+def init_worker(tokens):
+    """
+    Seed the CloudTrail function's token registry in a worker process so its
+    match stage runs entirely in memory.
+    """
+    global key_pattern
+
+    registry = task_cloudtrail_event.token_registry
+    registry.max_age = max(registry.max_age, 1)
+    registry.tokens = tokens
+    registry.access_key_ids = None
+    key_pattern = task_cloudtrail_event.build_key_pattern(registry.get_access_key_ids())
+
+
+def replay_file(path):
+    """
+    Find honey events in a single CloudTrail file.
+    """
+    honey_key_ids = task_cloudtrail_event.token_registry.get_access_key_ids()
+
+    if path.startswith('s3://'):
+        bucket, _, object_key = path[len('s3://'):].partition('/')
+        response = task_cloudtrail_event.download_cloudtrail_file(bucket, object_key, honey_key_ids, key_pattern)
+        file = response['Body'] if response is not None else None
+    else:
+        with open(path, 'rb') as f:
+            found = task_cloudtrail_event.file_has_honey_keys(f, honey_key_ids, key_pattern)
+        file = open(path, 'rb') if found else None
+
+    if file is None:
+        return []
+
+    records = task_cloudtrail_event.parse_cloudtrail_files([file])
+    return task_cloudtrail_event.parse_user_events(records)
+
+
+def replay(source, output, checkpoint=None, start=None, end=None, workers=None):
+    """
+    Replay all CloudTrail files under source, writing honey events to the
+    output stream. Files already listed in the checkpoint file are skipped,
+    and each file is added to it once its events have been written, so an
+    interrupted run can be resumed. Events of a file that was being written
+    during an interruption may be emitted twice.
+    """
+    workers = workers or os.cpu_count()
+    tokens = app_common.HoneyToken.get_active_tokens()
+    logger.info("Loaded {} active honey tokens.".format(len(tokens)))
+
+    done = load_checkpoint(checkpoint)
+    paths = (
+        path for path in list_cloudtrail_files(source)
+        if path not in done and in_date_range(path, start, end)
+    )
+    stats = {'files': 0, 'honey_events': 0, 'failed_files': 0}
+
+    checkpoint_file = open(checkpoint, 'a') if checkpoint else None
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_worker,
+        initargs=(tokens,)
+    )
+
+    try:
+        pending = {executor.submit(replay_file, path): path for path in itertools.islice(paths, workers * 4)}
+
+        while pending:
+            completed, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in completed:
+                path = pending.pop(future)
+
+                for next_path in itertools.islice(paths, 1):
+                    pending[executor.submit(replay_file, next_path)] = next_path
+
+                try:
+                    honey_events = future.result()
+                except Exception:
+                    logger.exception("Failed to replay {}".format(path))
+                    stats['failed_files'] += 1
+                    continue
+
+                for honey_event in honey_events:
+                    output.write(json.dumps(honey_event, cls=app_common.DecimalEncoder) + '\n')
+                output.flush()
+
+                if checkpoint_file:
+                    checkpoint_file.write(path + '\n')
+                    checkpoint_file.flush()
+
+                stats['files'] += 1
+                stats['honey_events'] += len(honey_events)
+    finally:
+        executor.shutdown()
+        if checkpoint_file:
+            checkpoint_file.close()
+
+    return stats
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay honey token detection over archived CloudTrail files.")
+    parser.add_argument('source', help="Local directory or s3://bucket/prefix of CloudTrail .json.gz files.")
+    parser.add_argument('--output', '-o', default='-', help="NDJSON output file, appended to. Defaults to stdout.")
+    parser.add_argument('--checkpoint', help="File recording completed CloudTrail files, for resuming.")
+    parser.add_argument('--start', type=parse_date, help="First delivery date to include (YYYY-MM-DD).")
+    parser.add_argument('--end', type=parse_date, help="Last delivery date to include (YYYY-MM-DD).")
+    parser.add_argument('--workers', type=int, help="Number of worker processes. Defaults to CPU count.")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, format="%(asctime)s %(levelname)s %(message)s")
+    end = args.end + datetime.timedelta(days=1) if args.end else None
+
+    if args.output == '-':
+        stats = replay(args.source, sys.stdout, args.checkpoint, args.start, end, args.workers)
+    else:
+        with open(args.output, 'a') as output:
+            stats = replay(args.source, output, args.checkpoint, args.start, end, args.workers)
+
+    logger.info(json.dumps(stats))
+    return 1 if stats['failed_files'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
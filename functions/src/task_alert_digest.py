@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+"""
+Runs on a schedule in digest mode. Publishes one alert for each honey token
+digest whose window has passed, and clears the digest.
+"""
+
+import app_common
+import task_common
+import boto3
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+sns = boto3.client('sns')
+
+
+def main(event, _context):
+    app_common.identity_map.clear()
+
+    logger.info(json.dumps(event))
+    current_time = int(time.time())
+
+    digests = {}
+    for access_key_id in app_common.AlertDigest.get_due_access_key_ids(current_time):
+        item = app_common.AlertDigest.pop(access_key_id)
+        if item is not None:
+            logger.info("SENDING DIGEST ALERT")
+            digests[task_common.build_digest_alert(item)] = item
+
+    failed = task_common.publish_sns_messages(sns, os.environ['HONEY_ALERT_SNS_TOPIC_ARN'], list(digests))
+
+    # Put digests that failed to publish back, due again on the next run.
+    for failure in failed:
+        app_common.AlertDigest.restore(digests[failure['message']], current_time)
+
+    return {
+        'num_digests': len(digests),
+        'num_failed_publishes': len(failed)
+    }
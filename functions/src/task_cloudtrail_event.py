@@ -8,53 +8,395 @@ and sends them to the honey token event task.
 import app_common
 import task_common
 import boto3
+import botocore.config
+import collections
+import concurrent.futures
+import contextlib
 import gzip
+import io
+import itertools
 import json
 import logging
 import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
 import time
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3 = boto3.client('s3')
+# Number of CloudTrail objects fetched and parsed at the same time.
+FETCH_CONCURRENCY = max(1, int(os.environ.get('CLOUDTRAIL_FETCH_CONCURRENCY', 8)))
+
+s3 = boto3.client('s3', config=botocore.config.Config(max_pool_connections=max(10, FETCH_CONCURRENCY * 2)))
 sns = boto3.client('sns')
 current_time = int(time.time())
 
+# Characters of decompressed text read from S3 per streaming read.
+STREAM_CHUNK_SIZE = 256 * 1024
+# Compressed bytes of a CloudTrail file kept in memory between the honey key
+# scan and parsing. Larger files are spooled to /tmp.
+SPOOL_MEMORY_SIZE = 1024 * 1024
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# Shape of IAM user access key IDs, used to find candidate keys in raw bytes.
+ACCESS_KEY_PATTERN = re.compile(rb'AKIA[A-Z0-9]{16}')
+
+# Record honey events and send alerts from this function instead of handing
+# them to the honey token event function over SNS.
+HONEY_EVENT_INLINE = os.environ.get('HONEY_EVENT_INLINE', "false").lower() == "true"
+
+# How long in seconds processed CloudTrail files are remembered. 0 disables
+# the processed-object ledger.
+PROCESSED_OBJECT_TTL = int(os.environ.get('PROCESSED_OBJECT_TTL', 0))
+# Claims outlive the invocation by this many seconds; Lambda's first retry
+# of a failed asynchronous invocation comes about a minute after it.
+CLAIM_LEASE_MARGIN = 30
+CLAIM_LEASE_DEFAULT = 900
+
+# IAM key events buffered before their access keys are looked up together.
+LOOKUP_BATCH_SIZE = 5000
+# Parsed records waiting to be handed from the fetch threads to the handler.
+RECORD_QUEUE_SIZE = 1000
+
+# Kept across warm invocations.
+token_registry = app_common.HoneyTokenRegistry(
+    int(os.environ.get('TOKEN_REGISTRY_MAX_AGE', 300)),
+    os.environ.get('HONEY_KEY_FILTER_BUCKET')
+)
+
+
+class CloudTrailRecord(collections.namedtuple('CloudTrailRecord', [
+        'access_key_id',
+        'event_id',
+        'event_time',
+        'event_name',
+        'aws_region',
+        'request_parameters',
+        'source_ip_address',
+        'user_agent'])):
+    """
+    The fields of a CloudTrail record that honey token detection uses.
+    Records are projected into this as they are parsed, so large nested data
+    such as responseElements and resources is dropped straight away.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            record['userIdentity']['accessKeyId'],
+            record.get('eventID'),
+            record.get('eventTime'),
+            record.get('eventName'),
+            record.get('awsRegion'),
+            record.get('requestParameters'),
+            record.get('sourceIPAddress'),
+            record.get('userAgent')
+        )
+
+    def get_dict(self):
+        """
+        CloudTrail-shaped dict with only the projected fields, as sent to the
+        honey token event function.
+        """
+        return {
+            'eventID': self.event_id,
+            'eventTime': self.event_time,
+            'eventName': self.event_name,
+            'awsRegion': self.aws_region,
+            'requestParameters': self.request_parameters,
+            'sourceIPAddress': self.source_ip_address,
+            'userAgent': self.user_agent,
+            'userIdentity': {'accessKeyId': self.access_key_id}
+        }
+
 
-def download_cloudtrail_files(sns_messages):
+class SpoolingReader:
     """
-    Download CloudTrail files mentioned in SNS event.
+    Reads a stream while copying everything read into a spool file, so the
+    stream can be read again from the spool without fetching it twice.
     """
-    files = []
+    def __init__(self, stream, spool):
+        self.stream = stream
+        self.spool = spool
 
-    download_dir = '/tmp/cloudtrail'
-    os.makedirs(download_dir, exist_ok=True)
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.spool.write(data)
+        return data
+
+
+def download_cloudtrail_file(bucket, object_key, honey_key_ids=None, key_pattern=None):
+    """
+    Open a CloudTrail file, returning the S3 GetObject response with its
+    streaming 'Body'.
+
+    If a set of honey key IDs is given, the object is scanned as raw bytes as
+    it streams in, and None is returned when none of the keys appear in it.
+    The compressed bytes are copied to a spool file on the way, kept in
+    memory up to SPOOL_MEMORY_SIZE and in /tmp beyond that. For objects that
+    do match, 'Body' is replaced by the spool, so each object is downloaded
+    only once.
+    """
+    response = s3.get_object(Bucket=bucket, Key=object_key)
+
+    if honey_key_ids is not None:
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE)
+
+        try:
+            with contextlib.closing(response['Body']) as file:
+                key_pattern = key_pattern or build_key_pattern(honey_key_ids)
+                if not file_has_honey_keys(SpoolingReader(file, spool), honey_key_ids, key_pattern):
+                    spool.close()
+                    return None
+
+                # Keys were found before the end; spool the rest for parsing.
+                shutil.copyfileobj(file, spool, STREAM_CHUNK_SIZE)
+        except Exception:
+            spool.close()
+            raise
+
+        spool.seek(0)
+        response['Body'] = spool
+
+    return response
+
+
+def get_cloudtrail_objects(sns_messages):
+    """
+    List the (bucket, key) pairs of CloudTrail files mentioned in SNS event.
+    """
+    return [
+        (message['s3Bucket'], object_key)
+        for message in sns_messages
+        for object_key in message['s3ObjectKey']
+    ]
+
+
+def fetch_cloudtrail_records(cloudtrail_objects, honey_key_ids=None, concurrency=FETCH_CONCURRENCY,
+                             errors=None, completed=None):
+    """
+    Fetch, scan and parse CloudTrail files with a bounded thread pool,
+    yielding IAM key records as they are parsed. At most `concurrency` files
+    are in flight at once, and their records reach the caller through a
+    queue of at most RECORD_QUEUE_SIZE, so memory use does not grow with the
+    size of the files. If a set of honey key IDs is given, only records made
+    with one of them are passed on.
+
+    A file that fails is logged and appended to `errors` (if given) without
+    stopping the rest of the batch. Records it yielded before failing are
+    not taken back. Files that were handled are appended to `completed` (if
+    given) along with their ETag.
+    """
+    key_pattern = build_key_pattern(honey_key_ids) if honey_key_ids is not None else None
+    objects = iter(cloudtrail_objects)
+    skipped = 0
+    results = queue.Queue(maxsize=RECORD_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(result):
+        # Give up once the caller has stopped reading.
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def fetch(bucket, object_key):
+        try:
+            response = download_cloudtrail_file(bucket, object_key, honey_key_ids, key_pattern)
+            if response is None:
+                put(('skipped', bucket, object_key, None))
+                return
+
+            for record in parse_cloudtrail_files([response['Body']]):
+                if honey_key_ids is None or record.access_key_id.encode('utf-8') in honey_key_ids:
+                    if not put(('record', record)):
+                        return
+
+            put(('done', bucket, object_key, response.get('ETag')))
+        except Exception as e:
+            logger.exception("Failed to process s3://{}/{}".format(bucket, object_key))
+            put(('failed', bucket, object_key, str(e)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        running = 0
+        for cloudtrail_object in itertools.islice(objects, concurrency):
+            executor.submit(fetch, *cloudtrail_object)
+            running += 1
+
+        try:
+            while running:
+                result = results.get()
+                if result[0] == 'record':
+                    yield result[1]
+                    continue
+
+                status, bucket, object_key, detail = result
+                running -= 1
+                for cloudtrail_object in itertools.islice(objects, 1):
+                    executor.submit(fetch, *cloudtrail_object)
+                    running += 1
+
+                if status == 'failed':
+                    if errors is not None:
+                        errors.append({'s3Bucket': bucket, 's3ObjectKey': object_key, 'error': detail})
+                    continue
+
+                if completed is not None:
+                    completed.append({'s3Bucket': bucket, 's3ObjectKey': object_key, 'ETag': detail})
+                if status == 'skipped':
+                    skipped += 1
+        finally:
+            stop.set()
+
+    if key_pattern is not None:
+        logger.info("Skipped {} CloudTrail files with no honey key IDs.".format(skipped))
+
+
+def build_key_pattern(honey_key_ids):
+    """
+    Build a regex that finds every honey key ID in raw bytes. When all keys
+    look like IAM user keys, a single generic pattern is used and matches are
+    checked against the set, which keeps the scan cost independent of the
+    number of tokens.
+    """
+    if all(ACCESS_KEY_PATTERN.fullmatch(key) for key in honey_key_ids):
+        return ACCESS_KEY_PATTERN
+
+    return re.compile(b'|'.join(re.escape(key) for key in sorted(honey_key_ids, key=len, reverse=True)))
+
+
+def file_has_honey_keys(file, honey_key_ids, key_pattern):
+    """
+    Scan the decompressed bytes of a gzipped CloudTrail file for any of the
+    honey key IDs without decoding any JSON.
+    """
+    if not honey_key_ids:
+        return False
 
-    for message in sns_messages:
-        for object_key in message['s3ObjectKey']:
-            cloudtrail_file = "{}/{}".format(download_dir, object_key.split('/')[-1])
-            s3.download_file(message['s3Bucket'], object_key, cloudtrail_file)
-            files.append(cloudtrail_file)
+    overlap = max(len(key) for key in honey_key_ids) - 1
+    stream = gzip.GzipFile(fileobj=file, mode='rb')
+    tail = b''
 
-    return files
+    while True:
+        chunk = stream.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            return False
+
+        data = tail + chunk
+        if not honey_key_ids.isdisjoint(key_pattern.findall(data)):
+            return True
+
+        tail = data[-overlap:] if overlap else b''
+
+
+def iter_json_records(stream, array_key='Records'):
+    """
+    Incrementally yield the items of a top-level JSON array (CloudTrail's
+    'Records') from a text stream. Only the record being decoded and one read
+    chunk are held in memory at a time.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    state = 'start'
+    key = None
+
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+
+        if pos < len(buf):
+            char = buf[pos]
+
+            if state == 'start':
+                if char != '{':
+                    raise ValueError("Expected JSON object at start of CloudTrail file.")
+                pos += 1
+                state = 'key'
+                continue
+
+            if state in ('key', 'item') and char == ',':
+                pos += 1
+                continue
+
+            if state == 'key' and char == '}':
+                return
+
+            if state == 'colon':
+                if char != ':':
+                    raise ValueError("Expected ':' after key in CloudTrail file.")
+                pos += 1
+                state = 'array' if key == array_key else 'value'
+                continue
+
+            if state == 'array':
+                if char != '[':
+                    raise ValueError("Expected '{}' to be a JSON array.".format(array_key))
+                pos += 1
+                state = 'item'
+                continue
+
+            if state == 'item' and char == ']':
+                pos += 1
+                state = 'key'
+                continue
+
+            # Remaining states decode a full JSON value (key, skipped value or
+            # array item). Objects, arrays and strings end with their own
+            # closing character, but a number may be cut short by the end of
+            # the buffer ("1." of "1.5e10" decodes as 1), so one is only
+            # accepted once the delimiter after it has been read, or at EOF.
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                after = WHITESPACE.match(buf, end).end()
+                if eof or char in '{["' or (after < len(buf) and buf[after] in ',:]}'):
+                    pos = end
+                    if state == 'key':
+                        key = value
+                        state = 'colon'
+                    elif state == 'value':
+                        state = 'key'
+                    else:
+                        yield value
+                    continue
+
+        if eof:
+            raise ValueError("Unexpected end of CloudTrail file.")
+
+        # Read more. The read size grows with the unconsumed buffer so a
+        # record larger than one chunk does not get re-decoded quadratically.
+        chunk = stream.read(max(STREAM_CHUNK_SIZE, len(buf) - pos))
+        buf = buf[pos:] + chunk
+        pos = 0
+        eof = not chunk
 
 
 def parse_cloudtrail_files(files):
     """
     Extract CloudTrail events that were performed with an IAM user key.
+    Each gzipped file is decompressed and parsed incrementally, and matching
+    records are yielded as CloudTrailRecords as they are found.
     """
-    records = []
-
     for file in files:
-        with gzip.open(file, 'rb') as f:
-            cloudtrail_records = json.load(f)
-
-        for record in cloudtrail_records['Records']:
-            if 'accessKeyId' in record['userIdentity']:
-                records.append(record)
+        with contextlib.closing(file):
+            stream = io.TextIOWrapper(gzip.GzipFile(fileobj=file, mode='rb'), encoding='utf-8')
 
-    return records
+            for record in iter_json_records(stream):
+                if 'accessKeyId' in record['userIdentity']:
+                    yield CloudTrailRecord.from_record(record)
 
 
 def parse_user_events(cloudtrail_user_events):
@@ -62,54 +404,173 @@ def parse_user_events(cloudtrail_user_events):
     Filter user events for those performed with honey tokens.
     Honey token must be marked active and have an expiration time of
     0 or greater than now.
+
+    Events are taken in batches, and each access key ID is looked up at most
+    once per invocation in the honey token registry.
     """
     honey_events = []
+    tokens = {}
 
-    for ct_event in cloudtrail_user_events:
-        access_key_id = ct_event['userIdentity']['accessKeyId']
-        token = app_common.HoneyToken(access_key_id)
+    for batch in iter_batches(cloudtrail_user_events, LOOKUP_BATCH_SIZE):
+        new_keys = {ct_event.access_key_id for ct_event in batch} - tokens.keys()
+        if new_keys:
+            found = token_registry.get_tokens(new_keys)
+            tokens.update({access_key_id: found.get(access_key_id) for access_key_id in new_keys})
 
-        if token.exists and token.active and (token.expire_time == 0 or token.expire_time > current_time):
-            honey_events.append({
-                'honey_event': ct_event,
-                'token': token.get_dict()
-            })
+        for ct_event in batch:
+            token = tokens[ct_event.access_key_id]
+
+            if token and token.active and (token.expire_time == 0 or token.expire_time > current_time):
+                honey_events.append({
+                    'honey_event': ct_event.get_dict(),
+                    'token': token.get_dict()
+                })
 
     return honey_events
 
 
-def honey_event_notify(honey_events):
+def iter_batches(iterable, size):
     """
-    Forward honey events to honey event SNS topic.
+    Group an iterable into lists of at most `size` items.
     """
-    sns_topic_arn = os.environ['HONEY_EVENT_SNS_TOPIC_ARN']
+    batch = []
+
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
 
+    if batch:
+        yield batch
+
+
+def honey_event_notify(honey_events):
+    """
+    Forward honey events to honey event SNS topic, or in inline mode record
+    them and send alerts directly. Returns the number of events (or alerts,
+    inline) that could not be published.
+    """
     for honey_event in honey_events:
         logger.info("FOUND HONEY TOKEN EVENT!")
         logger.info(json.dumps(honey_event, cls=app_common.DecimalEncoder))
-        sns.publish(
-            TopicArn=sns_topic_arn,
-            Message=json.dumps(honey_event, cls=app_common.DecimalEncoder)
-        )
+
+    if HONEY_EVENT_INLINE:
+        return len(task_common.handle_honey_events(
+            sns, honey_events, int(os.environ['ALERT_COOLDOWN']), os.environ['HONEY_ALERT_SNS_TOPIC_ARN'],
+            int(os.environ.get('ALERT_DIGEST_WINDOW', 0))))
+
+    messages = [json.dumps(honey_event, cls=app_common.DecimalEncoder) for honey_event in honey_events]
+    return len(task_common.publish_sns_messages(sns, os.environ['HONEY_EVENT_SNS_TOPIC_ARN'], messages))
+
+
+def get_claim_lease(context):
+    """
+    Seconds to claim CloudTrail files for: the rest of this invocation plus
+    a margin, so the claims lapse by the time Lambda retries a dead one.
+    """
+    if context is None:
+        return CLAIM_LEASE_DEFAULT
+
+    return context.get_remaining_time_in_millis() // 1000 + CLAIM_LEASE_MARGIN
+
+
+def claim_cloudtrail_objects(cloudtrail_objects, lease):
+    """
+    Drop CloudTrail files the processed-object ledger says are already done,
+    then claim the rest so concurrent redeliveries do not process them too.
+    Returns the files this invocation now owns and the files another
+    invocation still holds.
+    """
+    if PROCESSED_OBJECT_TTL <= 0:
+        return cloudtrail_objects, []
+
+    processed = app_common.ProcessedObject.get_processed(cloudtrail_objects)
+    claimed = []
+    held = []
+
+    for bucket, object_key in cloudtrail_objects:
+        if (bucket, object_key) in processed:
+            continue
+        if app_common.ProcessedObject.claim(bucket, object_key, PROCESSED_OBJECT_TTL, lease):
+            claimed.append((bucket, object_key))
+        else:
+            held.append((bucket, object_key))
+
+    logger.info("Claimed {} of {} CloudTrail files; {} already processed, {} held by other invocations.".format(
+        len(claimed), len(cloudtrail_objects), len(processed), len(held)))
+    return claimed, held
 
 
-def main(event, _context):
+def settle_cloudtrail_objects(claimed, completed, published):
+    """
+    Record completed CloudTrail files in the ledger and release the claims on
+    the rest so a retry picks them up. If honey events could not all be
+    published, every claim is released.
+    """
+    if PROCESSED_OBJECT_TTL <= 0:
+        return
+
+    done = set()
+    if published:
+        for cloudtrail_object in completed:
+            app_common.ProcessedObject.complete(
+                cloudtrail_object['s3Bucket'],
+                cloudtrail_object['s3ObjectKey'],
+                cloudtrail_object['ETag'],
+                PROCESSED_OBJECT_TTL
+            )
+            done.add((cloudtrail_object['s3Bucket'], cloudtrail_object['s3ObjectKey']))
+
+    for bucket, object_key in claimed:
+        if (bucket, object_key) not in done:
+            app_common.ProcessedObject.release(bucket, object_key)
+
+
+def main(event, context):
     """
     Lambda handler function
     """
     logger.info("Start cloudtrail-event function.")
+    app_common.identity_map.clear()
     logger.info(json.dumps(event))
 
     sns_messages = task_common.parse_sns_event_records(event['Records'])
-    cloudtrail_files = download_cloudtrail_files(sns_messages)
-    cloudtrail_user_events = parse_cloudtrail_files(cloudtrail_files)
-    honey_events = parse_user_events(cloudtrail_user_events)
-    honey_event_notify(honey_events)
+    token_registry.sync()
+    cloudtrail_objects, held_objects = claim_cloudtrail_objects(
+        get_cloudtrail_objects(sns_messages), get_claim_lease(context))
 
-    logger.info(json.dumps({'honey_events': honey_events}))
+    errors = []
+    completed = []
+    try:
+        cloudtrail_user_events = fetch_cloudtrail_records(
+            cloudtrail_objects, token_registry.get_access_key_ids(), errors=errors, completed=completed)
+        honey_events = parse_user_events(cloudtrail_user_events)
+        num_failed_publishes = honey_event_notify(honey_events)
+    except Exception:
+        settle_cloudtrail_objects(cloudtrail_objects, completed, False)
+        raise
+
+    settle_cloudtrail_objects(cloudtrail_objects, completed, num_failed_publishes == 0)
+
+    logger.info(json.dumps({'honey_events': honey_events}, cls=app_common.DecimalEncoder))
+    if errors:
+        logger.error(json.dumps({'failed_objects': errors}))
+    if held_objects:
+        logger.warning(json.dumps({'held_objects': held_objects}))
     logger.info("End cloudtrail-event function.")
 
+    # With the ledger on, fail the invocation so Lambda retries it. Only the
+    # files that are still pending will be processed again, including those
+    # another invocation was holding, in case it died before finishing them.
+    if PROCESSED_OBJECT_TTL > 0 and (errors or num_failed_publishes or held_objects):
+        raise Exception(
+            "{} CloudTrail files failed, {} are held by other invocations and {} honey events were not "
+            "published.".format(len(errors), len(held_objects), num_failed_publishes))
+
     return {
-        'status': "success",
-        'num_honey_events': len(honey_events)
+        'status': "partial" if errors or num_failed_publishes else "success",
+        'num_honey_events': len(honey_events),
+        'num_failed_publishes': num_failed_publishes,
+        'failed_objects': errors
     }
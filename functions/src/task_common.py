@@ -4,7 +4,21 @@
 Common functions for event tasks.
 """
 
+import app_common
+import concurrent.futures
+import dateutil.parser
 import json
+import logging
+import time
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# SNS PublishBatch limits.
+SNS_BATCH_SIZE = 10
+SNS_BATCH_BYTES = 256 * 1024
+SNS_RETRY_LIMIT = 5
+SNS_PUBLISH_CONCURRENCY = 4
 
 
 def parse_sns_event_records(records):
@@ -14,3 +28,212 @@ def parse_sns_event_records(records):
         messages.append(json.loads(record['Sns']['Message']))
 
     return messages
+
+
+def build_honey_token_event(message):
+    """
+    Build an unsaved Event from a {'honey_event': ..., 'token': ...} message
+    as produced by the CloudTrail function.
+    """
+    honey_event = app_common.Event()
+    honey_event.event_id = message['honey_event']['eventID']
+    honey_event.access_key_id = message['token']['access_key_id']
+    honey_event.event_time = int(dateutil.parser.parse(message['honey_event']['eventTime']).strftime('%s'))
+    honey_event.event_name = message['honey_event']['eventName']
+    honey_event.event_region = message['honey_event']['awsRegion']
+    honey_event.request_parameters = message['honey_event']['requestParameters']
+    honey_event.source_ip_address = message['honey_event']['sourceIPAddress']
+    honey_event.user_agent = message['honey_event']['userAgent']
+    return honey_event
+
+
+def set_alert_flags(honey_events, cooldown):
+    """
+    Decide which of a batch of events should alert, given the alert cooldown
+    in seconds. Events are grouped by token and walked in event time order.
+    Each alert is claimed with a conditional write on the token's alert
+    state, and once the state is known, events still in cooldown are
+    suppressed without another call. Returns the LastAlertTime each
+    claimed alert replaced, by event ID, for rolling it back.
+    """
+    by_token = {}
+    claims = {}
+    for honey_event in honey_events:
+        by_token.setdefault(honey_event.access_key_id, []).append(honey_event)
+
+    for access_key_id, token_events in by_token.items():
+        token_events.sort(key=lambda honey_event: honey_event.event_time)
+        last_alert_time = None
+
+        for honey_event in token_events:
+            if last_alert_time is not None and not app_common.AlertState.is_clear(
+                    last_alert_time, honey_event.event_time, cooldown):
+                honey_event.alerted = False
+                continue
+
+            honey_event.alerted, last_alert_time, previous_alert_time = app_common.AlertState.try_alert(
+                access_key_id, honey_event.event_time, cooldown)
+            if previous_alert_time is not None:
+                claims[honey_event.event_id] = previous_alert_time
+
+    return claims
+
+
+def add_to_digests(honey_events, messages, window):
+    """
+    Fold honey events into their tokens' alert digests, opening a digest that
+    flushes `window` seconds from now for tokens without one.
+    """
+    flush_time = int(time.time()) + window
+    by_token = {}
+
+    for honey_event, message in zip(honey_events, messages):
+        by_token.setdefault(honey_event.access_key_id, (message['token'], []))[1].append(honey_event)
+
+    for access_key_id, (token, token_events) in by_token.items():
+        app_common.AlertDigest.add(
+            access_key_id, token,
+            app_common.AlertDigest.summarize([honey_event.get_dict() for honey_event in token_events]), flush_time)
+
+
+def build_digest_alert(item):
+    return json.dumps({
+        'digest': app_common.AlertDigest.get_dict(item),
+        'token': item['Token']
+    }, cls=app_common.DecimalEncoder)
+
+
+def handle_honey_events(sns, messages, cooldown, alert_topic_arn, digest_window=0):
+    """
+    Record honey events and publish alerts for those that should alert.
+    Messages are {'honey_event': ..., 'token': ...} dicts as produced by the
+    CloudTrail function. Returns the alerts that could not be published.
+
+    With a digest window, events are added to their tokens' alert digests
+    instead, and the digest task sends the alerts.
+    """
+    honey_events = [build_honey_token_event(message) for message in messages]
+
+    if digest_window > 0:
+        for honey_event in honey_events:
+            honey_event.alerted = False
+        app_common.Event.save_events(honey_events)
+        add_to_digests(honey_events, messages, digest_window)
+        return []
+
+    claims = set_alert_flags(honey_events, cooldown)
+    app_common.Event.save_events(honey_events)
+
+    alerts = {}
+    for honey_event, message in sorted(zip(honey_events, messages), key=lambda pair: pair[0].event_time):
+        if honey_event.alerted:
+            logger.info("SENDING ALERT")
+            alerts[json.dumps({
+                'event': honey_event.get_dict(),
+                'token': message['token']
+            }, cls=app_common.DecimalEncoder)] = honey_event
+
+    failed = publish_sns_messages(sns, alert_topic_arn, list(alerts))
+
+    # Undo the alerts that were not sent, so a retry can still send them.
+    unsent = [alerts[failure['message']] for failure in failed]
+    for honey_event in unsent:
+        if honey_event.event_id in claims:
+            app_common.AlertState.release(
+                honey_event.access_key_id, honey_event.event_time, claims[honey_event.event_id])
+        honey_event.alerted = False
+
+    if unsent:
+        app_common.Event.save_events(unsent)
+
+    return failed
+
+
+def chunk_sns_messages(messages):
+    """
+    Group messages into PublishBatch sized chunks: at most 10 entries and
+    256 KB of payload each.
+    """
+    batch = []
+    batch_bytes = 0
+
+    for message in messages:
+        message_bytes = len(message.encode('utf-8'))
+
+        if batch and (len(batch) >= SNS_BATCH_SIZE or batch_bytes + message_bytes > SNS_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+        batch.append(message)
+        batch_bytes += message_bytes
+
+    if batch:
+        yield batch
+
+
+def publish_sns_batch(sns, topic_arn, messages):
+    """
+    Publish one chunk of messages with PublishBatch. Entries that fail
+    through no fault of the sender, and whole requests that are throttled,
+    are retried with exponential backoff. Returns the entries that could not
+    be published.
+    """
+    entries = {str(i): message for i, message in enumerate(messages)}
+    failed = []
+    errors = {}
+
+    for attempt in range(SNS_RETRY_LIMIT):
+        if attempt:
+            time.sleep(min(0.1 * 2 ** attempt, 5))
+
+        try:
+            response = sns.publish_batch(
+                TopicArn=topic_arn,
+                PublishBatchRequestEntries=[
+                    {'Id': entry_id, 'Message': message} for entry_id, message in entries.items()
+                ]
+            )
+        except sns.exceptions.ThrottledException as e:
+            errors = {entry_id: str(e) for entry_id in entries}
+            continue
+
+        for entry in response.get('Successful', []):
+            entries.pop(entry['Id'], None)
+
+        errors = {}
+        for entry in response.get('Failed', []):
+            if entry.get('SenderFault'):
+                failed.append({'message': entries.pop(entry['Id']), 'error': entry.get('Code')})
+            else:
+                errors[entry['Id']] = entry.get('Code')
+
+        if not entries:
+            break
+
+    for entry_id, message in entries.items():
+        failed.append({'message': message, 'error': errors.get(entry_id)})
+
+    return failed
+
+
+def publish_sns_messages(sns, topic_arn, messages, concurrency=SNS_PUBLISH_CONCURRENCY):
+    """
+    Publish messages to an SNS topic in PublishBatch chunks, with up to
+    `concurrency` chunks in flight at once. Returns the messages that could
+    not be published, each with its error code.
+    """
+    batches = list(chunk_sns_messages(messages))
+    failed = []
+
+    if not batches:
+        return failed
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(concurrency, len(batches))) as executor:
+        for batch_failed in executor.map(lambda batch: publish_sns_batch(sns, topic_arn, batch), batches):
+            failed.extend(batch_failed)
+
+    for failure in failed:
+        logger.error("Failed to publish SNS message to {}: {}".format(topic_arn, failure['error']))
+
+    return failed
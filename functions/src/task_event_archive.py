@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""
+Runs on a schedule when event retention is enabled. Archives each UTC day of
+honey token events to S3 once it has left the hot retention window, and
+advances the archive's ArchivedThrough mark past it.
+"""
+
+import app_common
+import json
+import logging
+import time
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DAY = app_common.EventArchive.day
+
+# Stop starting new days when less than this much time is left.
+TIME_RESERVE_MS = 60 * 1000
+
+
+def get_first_day(access_key_ids):
+    """
+    Start of the UTC day of the oldest event of any token, or None.
+    """
+    first_times = []
+
+    for access_key_id in access_key_ids:
+        events, _ = app_common.Event.get_events_for_token(access_key_id, limit=1)
+        first_times.extend(event['event_time'] for event in events)
+
+    if not first_times:
+        return None
+
+    return min(first_times) // DAY * DAY
+
+
+def main(event, context):
+    logger.info(json.dumps(event))
+    cutoff = int(time.time()) - app_common.Event.retention
+    access_key_ids = [token['access_key_id'] for token in app_common.HoneyToken.get_all_tokens()]
+
+    archived_through = app_common.EventArchive.get_archived_through()
+    if not archived_through:
+        first_day = get_first_day(access_key_ids)
+        archived_through = min(cutoff if first_day is None else first_day, cutoff) // DAY * DAY
+        app_common.EventArchive.set_archived_through(archived_through)
+
+    num_days = 0
+    num_events = 0
+    while archived_through + DAY <= cutoff and context.get_remaining_time_in_millis() > TIME_RESERVE_MS:
+        for access_key_id in access_key_ids:
+            num_events += app_common.EventArchive.archive_partition(access_key_id, archived_through)
+
+        archived_through += DAY
+        app_common.EventArchive.set_archived_through(archived_through)
+        num_days += 1
+
+    if archived_through + DAY <= cutoff:
+        logger.warning("Event archive is behind, archived through {}.".format(
+            app_common.EventArchive.get_date(archived_through)))
+
+    return {
+        'num_days': num_days,
+        'num_events': num_events,
+        'archived_through': archived_through
+    }
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+"""
+Consumes the events table stream and folds newly recorded honey events into
+per-token rollups, which the event stats API reads.
+
+Lambda retries a failed batch as a whole. Each token's part of a batch is
+identified by the stream sequence numbers of its first and last records, and
+the rollup skips writes it has already applied for it, so a retry does not
+count events twice.
+"""
+
+import app_common
+import boto3.dynamodb.types
+import json
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+deserializer = boto3.dynamodb.types.TypeDeserializer()
+
+
+def main(event, _context):
+    by_token = {}
+    sequence_numbers = {}
+
+    # Rewrites of an event, e.g. from redelivered notifications, are not
+    # INSERTs, and identical rewrites produce no stream record at all.
+    for record in event['Records']:
+        if record['eventName'] != 'INSERT':
+            continue
+
+        image = record['dynamodb']['NewImage']
+        item = {name: deserializer.deserialize(value) for name, value in image.items()}
+        honey_event = app_common.Event.get_item_dict(item)
+        by_token.setdefault(honey_event['access_key_id'], []).append(honey_event)
+        sequence_numbers.setdefault(honey_event['access_key_id'], []).append(record['dynamodb']['SequenceNumber'])
+
+    for access_key_id, token_events in by_token.items():
+        batch_id = "{}-{}".format(sequence_numbers[access_key_id][0], sequence_numbers[access_key_id][-1])
+        app_common.EventStats.add_summary(
+            access_key_id, app_common.EventStats.summarize(token_events), batch_id=batch_id)
+
+    result = {'num_events': sum(len(token_events) for token_events in by_token.values())}
+    logger.info(json.dumps(result))
+    return result
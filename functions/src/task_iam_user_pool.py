@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+"""
+Runs on a schedule. Keeps a pool of unused IAM honey users ready, so creating
+a honey token can take a free slot instead of creating an IAM user first.
+"""
+
+import app_common
+import json
+import logging
+import os
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def main(event, _context):
+    logger.info(json.dumps(event))
+    pool_size = int(os.environ['IAM_USER_POOL_SIZE'])
+
+    ready = app_common.IAMUser.count_users(num_tokens=0)
+    created = app_common.IAMUser.generate_many(pool_size - ready)
+
+    if ready + len(created) < pool_size:
+        logger.warning("IAM user pool has {} of {} users.".format(ready + len(created), pool_size))
+
+    return {
+        'num_ready_users': ready + len(created),
+        'num_created_users': len(created)
+    }
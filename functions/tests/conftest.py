@@ -0,0 +1,94 @@
+"""
+Test fixtures. AWS is mocked with moto, and the DynamoDB tables are created
+as terraform/dynamodb.tf defines them.
+"""
+
+import os
+import sys
+
+os.environ.update({
+    'APP_NAME': "spacesiren-test",
+    'AWS_DEFAULT_REGION': "us-east-1",
+    'AWS_ACCESS_KEY_ID': "testing",
+    'AWS_SECRET_ACCESS_KEY': "testing",
+    'AWS_SECURITY_TOKEN': "testing",
+    'AWS_SESSION_TOKEN': "testing",
+})
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+# moto must be imported before the functions create their boto3 clients.
+import boto3  # noqa: E402
+import moto  # noqa: E402
+import pytest  # noqa: E402
+
+APP_NAME = os.environ['APP_NAME']
+
+
+def create_table(dynamodb, name, hash_key, attributes, indexes=(), stream=False):
+    table_args = {
+        'TableName': "{}-{}".format(APP_NAME, name),
+        'KeySchema': [{'AttributeName': hash_key, 'KeyType': 'HASH'}],
+        'AttributeDefinitions': [
+            {'AttributeName': attribute, 'AttributeType': attribute_type}
+            for attribute, attribute_type in attributes.items()
+        ],
+        'BillingMode': 'PAY_PER_REQUEST'
+    }
+
+    if indexes:
+        table_args['GlobalSecondaryIndexes'] = [
+            {
+                'IndexName': index_name,
+                'KeySchema': [
+                    {'AttributeName': key, 'KeyType': key_type}
+                    for key, key_type in zip(keys, ('HASH', 'RANGE'))
+                ],
+                'Projection': {'ProjectionType': 'ALL'}
+            }
+            for index_name, keys in indexes
+        ]
+
+    if stream:
+        table_args['StreamSpecification'] = {'StreamEnabled': True, 'StreamViewType': 'NEW_IMAGE'}
+
+    dynamodb.create_table(**table_args)
+
+
+def save_event(event_id, access_key_id, event_time):
+    import app_common
+
+    event = app_common.Event()
+    event.event_id = event_id
+    event.access_key_id = access_key_id
+    event.alerted = False
+    event.event_name = "GetCallerIdentity"
+    event.event_time = event_time
+    event.event_region = "us-east-1"
+    event.request_parameters = None
+    event.source_ip_address = "192.0.2.1"
+    event.user_agent = "aws-cli"
+    event.save()
+    return event
+
+
+@pytest.fixture
+def aws():
+    with moto.mock_aws():
+        dynamodb = boto3.client('dynamodb')
+        create_table(dynamodb, 'api-keys', 'KeyID', {'KeyID': 'S'})
+        create_table(
+            dynamodb, 'events', 'EventID', {'EventID': 'S', 'EventTime': 'N', 'AccessKeyID': 'S'},
+            [('AccessKeyID-EventTime', ('AccessKeyID', 'EventTime'))], stream=True)
+        create_table(
+            dynamodb, 'iam-users', 'Username', {'Username': 'S', 'NumTokens': 'N'},
+            [('NumTokens', ('NumTokens',))])
+        create_table(dynamodb, 'state', 'StateID', {'StateID': 'S', 'FlushTime': 'N'}, [('FlushTime', ('FlushTime',))])
+        create_table(dynamodb, 'honey-tokens', 'AccessKeyID', {'AccessKeyID': 'S'})
+
+        boto3.client('iam').create_group(GroupName="{}-honey-users".format(APP_NAME))
+
+        import app_common
+        app_common.identity_map.clear()
+        app_common.account_id = None
+
+        yield
@@ -0,0 +1,65 @@
+import boto3
+import gzip
+import json
+import task_cloudtrail_event
+
+HONEY_KEY = "AKIAHONEYHONEYHONEY1"
+OTHER_KEY = "AKIAOTHEROTHEROTHER1"
+
+
+def build_record(i, access_key_id):
+    return {
+        'eventID': "event-{}".format(i),
+        'eventTime': "2021-01-01T00:00:00Z",
+        'eventName': "GetCallerIdentity",
+        'awsRegion': "us-east-1",
+        'requestParameters': None,
+        'sourceIPAddress': "192.0.2.1",
+        'userAgent': "aws-cli",
+        'userIdentity': {'accessKeyId': access_key_id}
+    }
+
+
+def put_cloudtrail_files(files):
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket="trail-bucket")
+
+    for object_key, body in files.items():
+        s3.put_object(Bucket="trail-bucket", Key=object_key, Body=body)
+
+    return [("trail-bucket", object_key) for object_key in files]
+
+
+def build_file(access_key_ids):
+    records = [build_record(i, access_key_id) for i, access_key_id in enumerate(access_key_ids)]
+    return gzip.compress(json.dumps({'Records': records}).encode('utf-8'))
+
+
+def test_fetch_cloudtrail_records(aws):
+    objects = put_cloudtrail_files({
+        'honey.json.gz': build_file([OTHER_KEY] * 50 + [HONEY_KEY] * 3),
+        'other.json.gz': build_file([OTHER_KEY] * 50),
+        'broken.json.gz': gzip.compress(("{\"Records\": [" + HONEY_KEY).encode('utf-8'))
+    })
+    errors = []
+    completed = []
+
+    records = list(task_cloudtrail_event.fetch_cloudtrail_records(
+        objects, frozenset([HONEY_KEY.encode('utf-8')]), concurrency=2, errors=errors, completed=completed))
+
+    assert [record.access_key_id for record in records] == [HONEY_KEY] * 3
+    assert [error['s3ObjectKey'] for error in errors] == ['broken.json.gz']
+    assert sorted(item['s3ObjectKey'] for item in completed) == ['honey.json.gz', 'other.json.gz']
+
+
+def test_fetch_cloudtrail_records_stops_with_caller(aws, monkeypatch):
+    monkeypatch.setattr(task_cloudtrail_event, 'RECORD_QUEUE_SIZE', 1)
+    objects = put_cloudtrail_files({
+        "file-{}.json.gz".format(i): build_file([OTHER_KEY] * 100) for i in range(4)
+    })
+
+    records = task_cloudtrail_event.fetch_cloudtrail_records(objects, concurrency=2)
+    assert next(records).access_key_id == OTHER_KEY
+
+    # Closing the generator must not leave the fetch threads blocked.
+    records.close()
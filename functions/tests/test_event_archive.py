@@ -0,0 +1,38 @@
+import app_common
+import boto3
+import task_event_archive
+import time
+from conftest import save_event
+
+DAY = app_common.EventArchive.day
+
+
+class Context:
+    def get_remaining_time_in_millis(self):
+        return 900 * 1000
+
+
+def test_archive_removes_archived_events(aws, monkeypatch):
+    boto3.client('s3').create_bucket(Bucket="archive-bucket")
+    monkeypatch.setattr(app_common.EventArchive, 'bucket', "archive-bucket")
+
+    token = app_common.HoneyToken()
+    token.generate()
+
+    # Written before retention was enabled, so without a TTL.
+    day_start = (int(time.time()) - 10 * DAY) // DAY * DAY
+    for i in range(30):
+        save_event("old-{}".format(i), token.access_key_id, day_start + i)
+    save_event("recent", token.access_key_id, int(time.time()))
+
+    monkeypatch.setattr(app_common.Event, 'retention', 5 * DAY)
+    result = task_event_archive.main({}, Context())
+
+    assert result['num_events'] == 30
+    assert app_common.EventArchive.get_archived_through() > day_start
+
+    # The partition is in S3 and gone from the events table.
+    archived = app_common.EventArchive.read_partition(token.access_key_id, app_common.EventArchive.get_date(day_start))
+    assert sorted(event['event_id'] for event in archived) == sorted("old-{}".format(i) for i in range(30))
+    assert not any(app_common.Event("old-{}".format(i)).exists for i in range(30))
+    assert app_common.Event("recent").exists
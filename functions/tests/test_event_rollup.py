@@ -0,0 +1,69 @@
+import app_common
+import boto3.dynamodb.types
+import task_event_rollup
+
+serializer = boto3.dynamodb.types.TypeSerializer()
+
+
+def build_stream_event(events, first_sequence_number=100):
+    records = []
+
+    for i, (event_id, access_key_id, event_name) in enumerate(events):
+        image = {
+            'EventID': event_id,
+            'AccessKeyID': access_key_id,
+            'Alerted': False,
+            'EventName': event_name,
+            'EventTime': 1600000000 + i,
+            'EventRegion': "us-east-1",
+            'RequestParameters': None,
+            'SourceIPAddress': "192.0.2.1",
+            'UserAgent': "aws-cli"
+        }
+        records.append({
+            'eventName': 'INSERT',
+            'dynamodb': {
+                'SequenceNumber': str(first_sequence_number + i),
+                'NewImage': {name: serializer.serialize(value) for name, value in image.items()}
+            }
+        })
+
+    return {'Records': records}
+
+
+def get_stats(access_key_id):
+    return app_common.EventStats.get_dict(app_common.EventStats.get_item(access_key_id))
+
+
+def test_rollup_counts_events(aws):
+    # Enough distinct values to take more than one write per token.
+    events = [("a-{}".format(i), "AKIAFIRST", "Action{}".format(i)) for i in range(30)]
+    events += [("b-1", "AKIASECOND", "GetUser"), ("b-2", "AKIASECOND", "GetUser")]
+
+    assert task_event_rollup.main(build_stream_event(events), None) == {'num_events': 32}
+
+    stats = get_stats("AKIAFIRST")
+    assert stats['event_count'] == 30
+    assert len(stats['event_names']) == 30
+    assert stats['source_ip_addresses'] == {"192.0.2.1": 30}
+
+    stats = get_stats("AKIASECOND")
+    assert stats['event_count'] == 2
+    assert stats['event_names'] == {"GetUser": 2}
+
+    # A later batch is added to the existing counts.
+    task_event_rollup.main(build_stream_event([("b-3", "AKIASECOND", "GetUser")], 200), None)
+    assert get_stats("AKIASECOND")['event_names'] == {"GetUser": 3}
+
+
+def test_rollup_retry_does_not_double_count(aws):
+    events = [("a-{}".format(i), "AKIAFIRST", "Action{}".format(i % 3)) for i in range(40)]
+    stream_event = build_stream_event(events)
+
+    task_event_rollup.main(stream_event, None)
+    task_event_rollup.main(stream_event, None)
+
+    stats = get_stats("AKIAFIRST")
+    assert stats['event_count'] == 40
+    assert sum(stats['event_names'].values()) == 40
+    assert stats['user_agents'] == {"aws-cli": 40}
@@ -0,0 +1,14 @@
+import app_common
+from conftest import save_event
+
+
+def test_delete_events_for_token(aws):
+    for i in range(30):
+        save_event("event-{}".format(i), "AKIAHONEY", 1600000000 + i)
+    save_event("other", "AKIAOTHER", 1600000000)
+
+    assert app_common.Event.delete_events_for_token("AKIAHONEY") == 30
+
+    events, _ = app_common.Event.get_events_for_token("AKIAHONEY")
+    assert events == []
+    assert app_common.Event("other").exists
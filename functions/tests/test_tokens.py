@@ -0,0 +1,111 @@
+import json
+import app_common
+import boto3
+import pytest
+
+
+def list_access_keys(username):
+    return boto3.client('iam').list_access_keys(UserName=username)['AccessKeyMetadata']
+
+
+def test_generate(aws):
+    token = app_common.HoneyToken()
+    token.generate()
+
+    saved = app_common.HoneyToken(token.access_key_id)
+    assert saved.exists
+    assert saved.username == token.username
+    assert int(app_common.IAMUser(token.username).num_tokens) == 1
+    assert [key['AccessKeyId'] for key in list_access_keys(token.username)] == [token.access_key_id]
+
+
+def test_generate_many(aws):
+    tokens = app_common.HoneyToken.generate_many([{'description': str(i)} for i in range(5)])
+
+    assert all(isinstance(token, app_common.HoneyToken) for token in tokens)
+    assert [token.description for token in tokens] == [str(i) for i in range(5)]
+
+    usernames = [token.username for token in tokens]
+    for username in set(usernames):
+        assert int(app_common.IAMUser(username).num_tokens) == usernames.count(username)
+        assert len(list_access_keys(username)) == usernames.count(username)
+
+
+def test_generate_deletes_access_key_on_error(aws, monkeypatch):
+    def fail(**kwargs):
+        raise app_common.dynamodb_client.exceptions.InternalServerError(
+            {'Error': {'Code': 'InternalServerError', 'Message': "Test"}}, 'TransactWriteItems')
+
+    monkeypatch.setattr(app_common.dynamodb_client, 'transact_write_items', fail)
+
+    with pytest.raises(app_common.dynamodb_client.exceptions.InternalServerError):
+        app_common.HoneyToken().generate()
+
+    for username in app_common.IAMUser.table.scan()['Items']:
+        assert list_access_keys(username['Username']) == []
+
+
+def test_delete(aws):
+    token = app_common.HoneyToken()
+    token.generate()
+    access_key_id, username = token.access_key_id, token.username
+
+    event = app_common.Event()
+    event.event_id = "event-1"
+    event.access_key_id = access_key_id
+    event.alerted = False
+    event.event_time = 1600000000
+    event.save()
+
+    app_common.HoneyToken(access_key_id).delete()
+
+    assert not app_common.HoneyToken(access_key_id).exists
+    assert not app_common.Event("event-1").exists
+    assert not app_common.IAMUser(username).exists
+
+
+def test_delete_retry_after_failure(aws, monkeypatch):
+    token = app_common.HoneyToken()
+    token.generate()
+    access_key_id = token.access_key_id
+
+    def fail(access_key_id):
+        raise Exception("Test")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(app_common.Event, 'delete_events_for_token', fail)
+        with pytest.raises(Exception):
+            app_common.HoneyToken(access_key_id).delete()
+
+    assert app_common.HoneyToken(access_key_id).exists
+
+    app_common.HoneyToken(access_key_id).delete()
+    assert not app_common.HoneyToken(access_key_id).exists
+
+
+def test_post_request_writes_token_once(aws, monkeypatch):
+    import api_token
+
+    def fail(self):
+        raise AssertionError("Token written twice.")
+
+    writes = []
+    transact_write_items = app_common.dynamodb_client.transact_write_items
+
+    def count(**kwargs):
+        writes.append(kwargs)
+        return transact_write_items(**kwargs)
+
+    monkeypatch.setattr(app_common.HoneyToken, 'save', fail)
+    monkeypatch.setattr(app_common.dynamodb_client, 'transact_write_items', count)
+
+    body = {'expire_time': 2000000000, 'active': False, 'location': "Laptop", 'description': "Test"}
+    response = api_token.post_request(body)
+    assert response['statusCode'] == 200
+    assert len(writes) == 1
+
+    saved = app_common.HoneyToken(json.loads(response['body'])['access_key_id'])
+    assert int(saved.expire_time) == 2000000000
+    assert not saved.active
+    assert saved.location == "Laptop"
+    assert saved.description == "Test"
@@ -226,9 +226,12 @@ data "aws_iam_policy_document" "lambda_function_api_token" {
     actions = [
       "dynamodb:GetItem",
       "dynamodb:PutItem",
+      "dynamodb:UpdateItem",
       "dynamodb:DeleteItem",
       "dynamodb:Scan",
       "dynamodb:Query",
+      "dynamodb:BatchGetItem",
+      "dynamodb:BatchWriteItem",
     ]
 
     resources = [
@@ -245,6 +248,7 @@ data "aws_iam_policy_document" "lambda_function_api_token" {
     actions = [
       "dynamodb:GetItem",
       "dynamodb:DeleteItem",
+      "dynamodb:BatchWriteItem",
       "dynamodb:Query",
     ]
 
@@ -254,6 +258,23 @@ data "aws_iam_policy_document" "lambda_function_api_token" {
     ]
   }
 
+  statement {
+    effect    = "Allow"
+    resources = [aws_dynamodb_table.state.arn]
+
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:UpdateItem",
+      "dynamodb:DeleteItem"
+    ]
+  }
+
+  statement {
+    effect    = "Allow"
+    actions   = ["s3:PutObject"]
+    resources = ["${data.aws_s3_bucket.functions.arn}/${var.app_name}/honey-key-filter.bin"]
+  }
+
   statement {
     effect    = "Allow"
     resources = ["*"]
@@ -286,6 +307,32 @@ data "aws_iam_policy_document" "lambda_function_api_token" {
       "arn:aws:iam::*:user/*"
     ]
   }
+
+  dynamic "statement" {
+    for_each = range(local.event_archive_enabled)
+
+    content {
+      effect    = "Allow"
+      actions   = ["s3:ListBucket"]
+      resources = ["arn:aws:s3:::${local.event_archive_bucket}"]
+
+      condition {
+        test     = "StringLike"
+        variable = "s3:prefix"
+        values   = ["${var.app_name}/event-archive/*"]
+      }
+    }
+  }
+
+  dynamic "statement" {
+    for_each = range(local.event_archive_enabled)
+
+    content {
+      effect    = "Allow"
+      actions   = ["s3:DeleteObject"]
+      resources = ["arn:aws:s3:::${local.event_archive_bucket}/${var.app_name}/event-archive/*"]
+    }
+  }
 }
 
 resource "aws_iam_policy" "api_token" {
@@ -311,7 +358,9 @@ module "lambda_function_api_token" {
   timeout          = 60
 
   environment = {
-    APP_NAME = var.app_name
+    APP_NAME                = var.app_name
+    HONEY_KEY_FILTER_BUCKET = data.aws_s3_bucket.functions.id
+    EVENT_ARCHIVE_BUCKET    = local.event_archive_bucket
   }
 
   app_name               = var.app_name
@@ -327,6 +376,14 @@ resource "aws_lambda_permission" "api_token" {
   source_arn    = "${aws_apigatewayv2_api.this.execution_arn}/*/*/token"
 }
 
+resource "aws_lambda_permission" "api_token_bulk" {
+  statement_id  = "AllowAPIGatewayInvokeBulk"
+  action        = "lambda:InvokeFunction"
+  function_name = module.lambda_function_api_token.function_name
+  principal     = "apigateway.amazonaws.com"
+  source_arn    = "${aws_apigatewayv2_api.this.execution_arn}/*/*/token/bulk"
+}
+
 resource "aws_apigatewayv2_integration" "api_token" {
   api_id                 = aws_apigatewayv2_api.this.id
   integration_type       = "AWS_PROXY"
@@ -351,6 +408,12 @@ resource "aws_apigatewayv2_route" "api_token_post" {
   target    = "integrations/${aws_apigatewayv2_integration.api_token.id}"
 }
 
+resource "aws_apigatewayv2_route" "api_token_bulk_post" {
+  api_id    = aws_apigatewayv2_api.this.id
+  route_key = "POST /token/bulk"
+  target    = "integrations/${aws_apigatewayv2_integration.api_token.id}"
+}
+
 resource "aws_apigatewayv2_route" "api_token_patch" {
   api_id    = aws_apigatewayv2_api.this.id
   route_key = "PATCH /token"
@@ -396,6 +459,38 @@ data "aws_iam_policy_document" "lambda_function_api_event" {
       "${aws_dynamodb_table.events.arn}/index/AccessKeyID-EventTime"
     ]
   }
+
+  statement {
+    effect    = "Allow"
+    actions   = ["dynamodb:GetItem"]
+    resources = [aws_dynamodb_table.state.arn]
+  }
+
+  dynamic "statement" {
+    for_each = range(local.event_archive_enabled)
+
+    content {
+      effect    = "Allow"
+      actions   = ["s3:ListBucket"]
+      resources = ["arn:aws:s3:::${local.event_archive_bucket}"]
+
+      condition {
+        test     = "StringLike"
+        variable = "s3:prefix"
+        values   = ["${var.app_name}/event-archive/*"]
+      }
+    }
+  }
+
+  dynamic "statement" {
+    for_each = range(local.event_archive_enabled)
+
+    content {
+      effect    = "Allow"
+      actions   = ["s3:GetObject"]
+      resources = ["arn:aws:s3:::${local.event_archive_bucket}/${var.app_name}/event-archive/*"]
+    }
+  }
 }
 
 resource "aws_iam_policy" "api_event" {
@@ -421,7 +516,8 @@ module "lambda_function_api_event" {
   timeout          = 60
 
   environment = {
-    APP_NAME = var.app_name
+    APP_NAME             = var.app_name
+    EVENT_ARCHIVE_BUCKET = local.event_archive_bucket
   }
 
   app_name               = var.app_name
@@ -437,6 +533,14 @@ resource "aws_lambda_permission" "api_event" {
   source_arn    = "${aws_apigatewayv2_api.this.execution_arn}/*/*/event"
 }
 
+resource "aws_lambda_permission" "api_event_stats" {
+  statement_id  = "AllowAPIGatewayInvokeStats"
+  action        = "lambda:InvokeFunction"
+  function_name = module.lambda_function_api_event.function_name
+  principal     = "apigateway.amazonaws.com"
+  source_arn    = "${aws_apigatewayv2_api.this.execution_arn}/*/*/event/stats"
+}
+
 resource "aws_apigatewayv2_integration" "api_event" {
   api_id                 = aws_apigatewayv2_api.this.id
   integration_type       = "AWS_PROXY"
@@ -455,6 +559,12 @@ resource "aws_apigatewayv2_route" "api_event_get" {
   target    = "integrations/${aws_apigatewayv2_integration.api_event.id}"
 }
 
+resource "aws_apigatewayv2_route" "api_event_stats_get" {
+  api_id    = aws_apigatewayv2_api.this.id
+  route_key = "GET /event/stats"
+  target    = "integrations/${aws_apigatewayv2_integration.api_event.id}"
+}
+
 #================================================
 # Test alert API function and endpoints
 #================================================
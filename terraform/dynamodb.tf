@@ -20,6 +20,10 @@ resource "aws_dynamodb_table" "events" {
   hash_key     = "EventID"
   billing_mode = "PAY_PER_REQUEST"
 
+  # Feeds the event rollup function.
+  stream_enabled   = true
+  stream_view_type = "NEW_IMAGE"
+
   attribute {
     name = "EventID"
     type = "S"
@@ -42,6 +46,12 @@ resource "aws_dynamodb_table" "events" {
     projection_type = "ALL"
   }
 
+  # Set on new events when event_retention_days is enabled.
+  ttl {
+    attribute_name = "ExpireTime"
+    enabled        = true
+  }
+
   lifecycle {
     prevent_destroy = true
   }
@@ -82,6 +92,37 @@ resource "aws_dynamodb_table" "iam_users" {
   tags = var.default_tags
 }
 
+resource "aws_dynamodb_table" "state" {
+  name         = "${var.app_name}-state"
+  hash_key     = "StateID"
+  billing_mode = "PAY_PER_REQUEST"
+
+  attribute {
+    name = "StateID"
+    type = "S"
+  }
+
+  attribute {
+    name = "FlushTime"
+    type = "N"
+  }
+
+  # Sparse: only open alert digests have a FlushTime.
+  global_secondary_index {
+    name               = "FlushTime"
+    hash_key           = "FlushTime"
+    projection_type    = "INCLUDE"
+    non_key_attributes = ["AccessKeyID"]
+  }
+
+  ttl {
+    attribute_name = "ExpireTime"
+    enabled        = true
+  }
+
+  tags = var.default_tags
+}
+
 resource "aws_dynamodb_table" "honey_tokens" {
   name         = "${var.app_name}-honey-tokens"
   hash_key     = "AccessKeyID"
@@ -15,8 +15,18 @@ data "aws_iam_policy_document" "lambda_function_task_cloudtrail_event" {
   }
 
   statement {
-    effect  = "Allow"
-    actions = ["dynamodb:GetItem"]
+    effect    = "Allow"
+    actions   = ["s3:GetObject"]
+    resources = ["${data.aws_s3_bucket.functions.arn}/${var.app_name}/honey-key-filter.bin"]
+  }
+
+  statement {
+    effect = "Allow"
+
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:BatchGetItem"
+    ]
 
     resources = [
       aws_dynamodb_table.honey_tokens.arn,
@@ -26,14 +36,46 @@ data "aws_iam_policy_document" "lambda_function_task_cloudtrail_event" {
 
   statement {
     effect    = "Allow"
-    actions   = ["dynamodb:PutItem"]
-    resources = [aws_dynamodb_table.events.arn]
+    actions   = ["dynamodb:Scan"]
+    resources = [aws_dynamodb_table.honey_tokens.arn]
   }
 
   statement {
     effect    = "Allow"
-    actions   = ["sns:Publish"]
-    resources = [aws_sns_topic.task_honey_token_event.arn]
+    resources = [aws_dynamodb_table.state.arn]
+
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:BatchGetItem",
+      "dynamodb:PutItem",
+      "dynamodb:UpdateItem",
+      "dynamodb:DeleteItem"
+    ]
+  }
+
+  statement {
+    effect = "Allow"
+
+    actions = [
+      "dynamodb:PutItem",
+      "dynamodb:BatchWriteItem",
+      "dynamodb:Query"
+    ]
+
+    resources = [
+      aws_dynamodb_table.events.arn,
+      "${aws_dynamodb_table.events.arn}/index/AccessKeyID-EventTime"
+    ]
+  }
+
+  statement {
+    effect  = "Allow"
+    actions = ["sns:Publish"]
+
+    resources = [
+      aws_sns_topic.task_honey_token_event.arn,
+      aws_sns_topic.alert_honey_token_event.arn
+    ]
   }
 }
 
@@ -64,8 +106,17 @@ module "task_cloudtrail_event_function" {
   policy_json = data.aws_iam_policy_document.lambda_function_task_cloudtrail_event.json
 
   environment = {
-    APP_NAME                  = var.app_name
-    HONEY_EVENT_SNS_TOPIC_ARN = aws_sns_topic.task_honey_token_event.arn
+    APP_NAME                     = var.app_name
+    HONEY_EVENT_SNS_TOPIC_ARN    = aws_sns_topic.task_honey_token_event.arn
+    TOKEN_REGISTRY_MAX_AGE       = var.token_registry_max_age
+    HONEY_KEY_FILTER_BUCKET      = data.aws_s3_bucket.functions.id
+    CLOUDTRAIL_FETCH_CONCURRENCY = var.cloudtrail_fetch_concurrency
+    PROCESSED_OBJECT_TTL         = var.processed_object_ttl
+    HONEY_EVENT_INLINE           = var.honey_event_inline
+    ALERT_COOLDOWN               = var.alert_cooldown
+    ALERT_DIGEST_WINDOW          = var.alert_digest_window
+    EVENT_RETENTION              = var.event_retention_days * 86400
+    HONEY_ALERT_SNS_TOPIC_ARN    = aws_sns_topic.alert_honey_token_event.arn
   }
 
   app_name               = var.app_name
@@ -100,6 +151,7 @@ data "aws_iam_policy_document" "lambda_function_task_honey_token_event" {
     actions = [
       "dynamodb:GetItem",
       "dynamodb:PutItem",
+      "dynamodb:BatchWriteItem",
       "dynamodb:Query"
     ]
 
@@ -109,6 +161,17 @@ data "aws_iam_policy_document" "lambda_function_task_honey_token_event" {
     ]
   }
 
+  statement {
+    effect    = "Allow"
+    resources = [aws_dynamodb_table.state.arn]
+
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:PutItem",
+      "dynamodb:UpdateItem"
+    ]
+  }
+
   statement {
     effect    = "Allow"
     actions   = ["sns:Publish"]
@@ -126,6 +189,8 @@ module "task_honey_token_event_function" {
   environment = {
     APP_NAME                  = var.app_name
     ALERT_COOLDOWN            = var.alert_cooldown
+    ALERT_DIGEST_WINDOW       = var.alert_digest_window
+    EVENT_RETENTION           = var.event_retention_days * 86400
     HONEY_ALERT_SNS_TOPIC_ARN = aws_sns_topic.alert_honey_token_event.arn
   }
 
@@ -136,3 +201,408 @@ module "task_honey_token_event_function" {
   sns_topic_arn          = aws_sns_topic.task_honey_token_event.arn
   tags                   = var.default_tags
 }
+
+#================================================
+# Alert digest
+#================================================
+locals {
+  alert_digest_enabled = var.alert_digest_window > 0 ? 1 : 0
+}
+
+data "aws_iam_policy_document" "lambda_function_task_alert_digest" {
+  statement {
+    effect = "Allow"
+
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:PutItem",
+      "dynamodb:UpdateItem",
+      "dynamodb:DeleteItem"
+    ]
+
+    resources = [aws_dynamodb_table.state.arn]
+  }
+
+  statement {
+    effect    = "Allow"
+    actions   = ["dynamodb:Scan"]
+    resources = ["${aws_dynamodb_table.state.arn}/index/FlushTime"]
+  }
+
+  statement {
+    effect    = "Allow"
+    actions   = ["sns:Publish"]
+    resources = [aws_sns_topic.alert_honey_token_event.arn]
+  }
+}
+
+resource "aws_iam_role" "task_alert_digest" {
+  count              = local.alert_digest_enabled
+  name               = "${var.app_name}-lambda-task-alert-digest"
+  assume_role_policy = data.aws_iam_policy_document.lambda_assume_role_policy.json
+}
+
+resource "aws_iam_policy" "task_alert_digest" {
+  count  = local.alert_digest_enabled
+  name   = "${var.app_name}-lambda-task-alert-digest"
+  policy = data.aws_iam_policy_document.lambda_function_task_alert_digest.json
+}
+
+resource "aws_iam_role_policy_attachment" "task_alert_digest" {
+  count      = local.alert_digest_enabled
+  role       = aws_iam_role.task_alert_digest[count.index].name
+  policy_arn = aws_iam_policy.task_alert_digest[count.index].arn
+}
+
+module "task_alert_digest_function" {
+  count  = local.alert_digest_enabled
+  source = "./modules/lambda-function"
+
+  type             = "task"
+  name             = "alert-digest"
+  description      = "Sends alert digests for honey tokens once their window has passed."
+  functions_bucket = data.aws_s3_bucket.functions.id
+  role_name        = aws_iam_role.task_alert_digest[count.index].name
+  role_arn         = aws_iam_role.task_alert_digest[count.index].arn
+  memory_size      = 256
+  timeout          = 60
+
+  environment = {
+    APP_NAME                  = var.app_name
+    HONEY_ALERT_SNS_TOPIC_ARN = aws_sns_topic.alert_honey_token_event.arn
+  }
+
+  app_name               = var.app_name
+  cloudwatch_expire_days = var.cloudwatch_expire_days
+  tags                   = var.default_tags
+}
+
+resource "aws_cloudwatch_event_rule" "task_alert_digest" {
+  count               = local.alert_digest_enabled
+  name                = "${var.app_name}-task-alert-digest"
+  description         = "Flushes due honey token alert digests."
+  schedule_expression = "rate(1 minute)"
+  tags                = var.default_tags
+}
+
+resource "aws_cloudwatch_event_target" "task_alert_digest" {
+  count = local.alert_digest_enabled
+  rule  = aws_cloudwatch_event_rule.task_alert_digest[count.index].name
+  arn   = module.task_alert_digest_function[count.index].function_arn
+}
+
+resource "aws_lambda_permission" "task_alert_digest" {
+  count         = local.alert_digest_enabled
+  statement_id  = "AllowExecutionFromCloudWatchEvents"
+  action        = "lambda:InvokeFunction"
+  function_name = module.task_alert_digest_function[count.index].function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.task_alert_digest[count.index].arn
+}
+
+#================================================
+# Event archive
+#================================================
+locals {
+  event_archive_enabled = var.event_retention_days > 0 ? 1 : 0
+  event_archive_bucket  = local.event_archive_enabled == 1 ? coalesce(var.event_archive_bucket, var.functions_bucket) : ""
+}
+
+data "aws_iam_policy_document" "lambda_function_task_event_archive" {
+  statement {
+    effect    = "Allow"
+    actions   = ["dynamodb:Scan"]
+    resources = [aws_dynamodb_table.honey_tokens.arn]
+  }
+
+  statement {
+    effect = "Allow"
+
+    actions = [
+      "dynamodb:Query",
+      "dynamodb:BatchWriteItem"
+    ]
+
+    resources = [
+      aws_dynamodb_table.events.arn,
+      "${aws_dynamodb_table.events.arn}/index/AccessKeyID-EventTime"
+    ]
+  }
+
+  statement {
+    effect = "Allow"
+
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:UpdateItem"
+    ]
+
+    resources = [aws_dynamodb_table.state.arn]
+  }
+
+  statement {
+    effect    = "Allow"
+    actions   = ["s3:PutObject"]
+    resources = ["arn:aws:s3:::${local.event_archive_bucket}/${var.app_name}/event-archive/*"]
+  }
+}
+
+resource "aws_iam_role" "task_event_archive" {
+  count              = local.event_archive_enabled
+  name               = "${var.app_name}-lambda-task-event-archive"
+  assume_role_policy = data.aws_iam_policy_document.lambda_assume_role_policy.json
+}
+
+resource "aws_iam_policy" "task_event_archive" {
+  count  = local.event_archive_enabled
+  name   = "${var.app_name}-lambda-task-event-archive"
+  policy = data.aws_iam_policy_document.lambda_function_task_event_archive.json
+}
+
+resource "aws_iam_role_policy_attachment" "task_event_archive" {
+  count      = local.event_archive_enabled
+  role       = aws_iam_role.task_event_archive[count.index].name
+  policy_arn = aws_iam_policy.task_event_archive[count.index].arn
+}
+
+module "task_event_archive_function" {
+  count  = local.event_archive_enabled
+  source = "./modules/lambda-function"
+
+  type             = "task"
+  name             = "event-archive"
+  description      = "Archives events past the retention window to S3."
+  functions_bucket = data.aws_s3_bucket.functions.id
+  role_name        = aws_iam_role.task_event_archive[count.index].name
+  role_arn         = aws_iam_role.task_event_archive[count.index].arn
+  memory_size      = 512
+  timeout          = 900
+
+  environment = {
+    APP_NAME             = var.app_name
+    EVENT_RETENTION      = var.event_retention_days * 86400
+    EVENT_ARCHIVE_BUCKET = local.event_archive_bucket
+  }
+
+  app_name               = var.app_name
+  cloudwatch_expire_days = var.cloudwatch_expire_days
+  tags                   = var.default_tags
+}
+
+resource "aws_cloudwatch_event_rule" "task_event_archive" {
+  count               = local.event_archive_enabled
+  name                = "${var.app_name}-task-event-archive"
+  description         = "Archives events past the retention window."
+  schedule_expression = "rate(1 hour)"
+  tags                = var.default_tags
+}
+
+resource "aws_cloudwatch_event_target" "task_event_archive" {
+  count = local.event_archive_enabled
+  rule  = aws_cloudwatch_event_rule.task_event_archive[count.index].name
+  arn   = module.task_event_archive_function[count.index].function_arn
+}
+
+resource "aws_lambda_permission" "task_event_archive" {
+  count         = local.event_archive_enabled
+  statement_id  = "AllowExecutionFromCloudWatchEvents"
+  action        = "lambda:InvokeFunction"
+  function_name = module.task_event_archive_function[count.index].function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.task_event_archive[count.index].arn
+}
+
+#================================================
+# Event rollup
+#================================================
+data "aws_iam_policy_document" "lambda_function_task_event_rollup" {
+  statement {
+    effect = "Allow"
+
+    actions = [
+      "dynamodb:DescribeStream",
+      "dynamodb:GetRecords",
+      "dynamodb:GetShardIterator",
+      "dynamodb:ListStreams"
+    ]
+
+    resources = [aws_dynamodb_table.events.stream_arn]
+  }
+
+  statement {
+    effect = "Allow"
+
+    actions = [
+      "dynamodb:PutItem",
+      "dynamodb:UpdateItem"
+    ]
+
+    resources = [aws_dynamodb_table.state.arn]
+  }
+}
+
+resource "aws_iam_role" "task_event_rollup" {
+  name               = "${var.app_name}-lambda-task-event-rollup"
+  assume_role_policy = data.aws_iam_policy_document.lambda_assume_role_policy.json
+}
+
+resource "aws_iam_policy" "task_event_rollup" {
+  name   = "${var.app_name}-lambda-task-event-rollup"
+  policy = data.aws_iam_policy_document.lambda_function_task_event_rollup.json
+}
+
+resource "aws_iam_role_policy_attachment" "task_event_rollup" {
+  role       = aws_iam_role.task_event_rollup.name
+  policy_arn = aws_iam_policy.task_event_rollup.arn
+}
+
+module "task_event_rollup_function" {
+  source = "./modules/lambda-function"
+
+  type             = "task"
+  name             = "event-rollup"
+  description      = "Maintains per-token event stats from the events table stream."
+  functions_bucket = data.aws_s3_bucket.functions.id
+  role_name        = aws_iam_role.task_event_rollup.name
+  role_arn         = aws_iam_role.task_event_rollup.arn
+  memory_size      = 256
+  timeout          = 60
+
+  environment = {
+    APP_NAME = var.app_name
+  }
+
+  app_name               = var.app_name
+  cloudwatch_expire_days = var.cloudwatch_expire_days
+  tags                   = var.default_tags
+}
+
+# Retries must redeliver the same batch for the rollup to recognise the writes
+# it already applied, so a failed batch is not split.
+resource "aws_lambda_event_source_mapping" "task_event_rollup" {
+  event_source_arn                   = aws_dynamodb_table.events.stream_arn
+  function_name                      = module.task_event_rollup_function.function_arn
+  starting_position                  = "LATEST"
+  batch_size                         = 500
+  maximum_batching_window_in_seconds = 5
+  bisect_batch_on_function_error     = false
+  maximum_retry_attempts             = 10
+
+  depends_on = [aws_iam_role_policy_attachment.task_event_rollup]
+}
+
+#================================================
+# IAM user pool
+#================================================
+locals {
+  iam_user_pool_enabled = var.iam_user_pool_size > 0 ? 1 : 0
+}
+
+data "aws_iam_policy_document" "lambda_function_task_iam_user_pool" {
+  statement {
+    effect = "Allow"
+
+    actions = [
+      "dynamodb:BatchGetItem",
+      "dynamodb:BatchWriteItem",
+    ]
+
+    resources = [aws_dynamodb_table.iam_users.arn]
+  }
+
+  statement {
+    effect    = "Allow"
+    actions   = ["dynamodb:Query"]
+    resources = ["${aws_dynamodb_table.iam_users.arn}/index/NumTokens"]
+  }
+
+  statement {
+    effect    = "Allow"
+    resources = ["*"]
+
+    actions = [
+      "iam:CreateUser",
+      "iam:TagUser",
+    ]
+
+    condition {
+      test     = "StringLike"
+      variable = "iam:ResourceTag/${var.app_name}-honey-user"
+      values   = ["true"]
+    }
+  }
+
+  statement {
+    effect  = "Allow"
+    actions = ["iam:AddUserToGroup"]
+
+    resources = [
+      aws_iam_group.honey_users.arn,
+      "arn:aws:iam::*:user/*"
+    ]
+  }
+}
+
+resource "aws_iam_role" "task_iam_user_pool" {
+  count              = local.iam_user_pool_enabled
+  name               = "${var.app_name}-lambda-task-iam-user-pool"
+  assume_role_policy = data.aws_iam_policy_document.lambda_assume_role_policy.json
+}
+
+resource "aws_iam_policy" "task_iam_user_pool" {
+  count  = local.iam_user_pool_enabled
+  name   = "${var.app_name}-lambda-task-iam-user-pool"
+  policy = data.aws_iam_policy_document.lambda_function_task_iam_user_pool.json
+}
+
+resource "aws_iam_role_policy_attachment" "task_iam_user_pool" {
+  count      = local.iam_user_pool_enabled
+  role       = aws_iam_role.task_iam_user_pool[count.index].name
+  policy_arn = aws_iam_policy.task_iam_user_pool[count.index].arn
+}
+
+module "task_iam_user_pool_function" {
+  count  = local.iam_user_pool_enabled
+  source = "./modules/lambda-function"
+
+  type             = "task"
+  name             = "iam-user-pool"
+  description      = "Keeps a pool of unused IAM honey users ready for new honey tokens."
+  functions_bucket = data.aws_s3_bucket.functions.id
+  role_name        = aws_iam_role.task_iam_user_pool[count.index].name
+  role_arn         = aws_iam_role.task_iam_user_pool[count.index].arn
+  memory_size      = 256
+  timeout          = 120
+
+  environment = {
+    APP_NAME           = var.app_name
+    IAM_USER_POOL_SIZE = var.iam_user_pool_size
+  }
+
+  app_name               = var.app_name
+  cloudwatch_expire_days = var.cloudwatch_expire_days
+  tags                   = var.default_tags
+}
+
+resource "aws_cloudwatch_event_rule" "task_iam_user_pool" {
+  count               = local.iam_user_pool_enabled
+  name                = "${var.app_name}-task-iam-user-pool"
+  description         = "Refills the pool of unused IAM honey users."
+  schedule_expression = "rate(5 minutes)"
+  tags                = var.default_tags
+}
+
+resource "aws_cloudwatch_event_target" "task_iam_user_pool" {
+  count = local.iam_user_pool_enabled
+  rule  = aws_cloudwatch_event_rule.task_iam_user_pool[count.index].name
+  arn   = module.task_iam_user_pool_function[count.index].function_arn
+}
+
+resource "aws_lambda_permission" "task_iam_user_pool" {
+  count         = local.iam_user_pool_enabled
+  statement_id  = "AllowExecutionFromCloudWatchEvents"
+  action        = "lambda:InvokeFunction"
+  function_name = module.task_iam_user_pool_function[count.index].function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.task_iam_user_pool[count.index].arn
+}
@@ -120,6 +120,12 @@ variable "alert_cooldown" {
   default     = 1800
 }
 
+variable "alert_digest_window" {
+  description = "Collect each honey token's events over this many seconds and send one summary alert for them, instead of alerting per event. Set 0 to disable."
+  type        = number
+  default     = 0
+}
+
 variable "api_burst_limit" {
   type    = number
   default = 10
@@ -135,6 +141,12 @@ variable "app_name" {
   default = "spacesiren"
 }
 
+variable "cloudtrail_fetch_concurrency" {
+  description = "Number of CloudTrail files the CloudTrail function fetches and parses at the same time."
+  type        = number
+  default     = 8
+}
+
 variable "cloudwatch_expire_days" {
   description = "Expiration period for CloudWatch log events."
   type        = number
@@ -146,3 +158,44 @@ variable "default_tags" {
   type    = map(string)
   default = {}
 }
+
+variable "event_archive_bucket" {
+  description = "S3 bucket for archived events. Defaults to the functions bucket."
+  type        = string
+  default     = ""
+}
+
+variable "event_retention_days" {
+  description = "How many days of events to keep in DynamoDB. Older events are archived to S3 and expired from DynamoDB. Set 0 to keep all events in DynamoDB."
+  type        = number
+  default     = 0
+}
+
+variable "honey_event_inline" {
+  description = "Record honey events and send alerts from the CloudTrail function directly, skipping the honey token event function."
+  type        = bool
+  default     = false
+}
+
+variable "iam_user_pool_size" {
+  description = "Number of unused IAM honey users to keep ready, so new honey tokens do not wait on IAM user creation. Set 0 to disable."
+  type        = number
+  default     = 0
+
+  validation {
+    condition     = var.iam_user_pool_size >= 0 && var.iam_user_pool_size <= 100
+    error_message = "The value for iam_user_pool_size must be between 0 and 100."
+  }
+}
+
+variable "processed_object_ttl" {
+  description = "How long in seconds the CloudTrail function remembers processed CloudTrail files, so redelivered notifications and retries skip them. Set 0 to disable."
+  type        = number
+  default     = 604800
+}
+
+variable "token_registry_max_age" {
+  description = "Maximum time in seconds the CloudTrail function caches honey tokens in memory before reloading them. Token changes are picked up sooner. Set 0 to disable the cache."
+  type        = number
+  default     = 300
+}